@@ -0,0 +1,65 @@
+# nlp_worker.py
+# Warm Uplink worker for the spaCy pipeline (server_code/TextPipeline.py).
+#
+# Loading en_core_web_sm takes seconds, and the Anvil server would otherwise load it
+# in every server process that optimizes a newsletter. This worker keeps a pool of
+# processes with the pipeline already loaded, and registers the functions that
+# OptimizeNewsletter._run_nlp calls. While it is connected, optimization sends its NLP
+# work here; when it is not, the server falls back to running the pipeline itself.
+#
+# Example:
+#   ANVIL_UPLINK_KEY=<server uplink key> python nlp_worker.py --processes 2
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import anvil.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server_code'))
+import TextPipeline
+
+_pool = None
+
+def _warm_up():
+    """Pool initializer: loads the pipeline once per worker process."""
+    TextPipeline.get_nlp()
+
+@anvil.server.callable('nlp_worker_chunk_sections')
+def chunk_sections(text, trading_day, section_rules=None):
+    return _pool.submit(TextPipeline.chunk_sections, text, trading_day, section_rules).result()
+
+@anvil.server.callable('nlp_worker_get_newsletter_sections')
+def get_newsletter_sections(text):
+    return _pool.submit(TextPipeline.get_newsletter_sections, text).result()
+
+@anvil.server.callable('nlp_worker_extract_key_levels')
+def extract_key_levels(text):
+    return _pool.submit(TextPipeline.extract_key_levels, text).result()
+
+@anvil.server.callable('nlp_worker_extract_sections_features')
+def extract_sections_features(texts):
+    # Spread a batch of sections over the pool
+    return list(_pool.map(TextPipeline.extract_section_features, texts))
+
+def main():
+    global _pool
+    parser = argparse.ArgumentParser(description="Serve the newsletter spaCy pipeline over Anvil Uplink")
+    parser.add_argument('--uplink-key', default=os.environ.get('ANVIL_UPLINK_KEY'),
+                        help="Server Uplink key (defaults to $ANVIL_UPLINK_KEY)")
+    parser.add_argument('--processes', type=int, default=2, help="Number of warm pipeline processes")
+    args = parser.parse_args()
+    if not args.uplink_key:
+        parser.error("an Uplink key is required (--uplink-key or ANVIL_UPLINK_KEY)")
+
+    _pool = ProcessPoolExecutor(max_workers=args.processes, initializer=_warm_up)
+    # Load the pipeline in every process before accepting calls
+    list(_pool.map(TextPipeline.extract_key_levels, [''] * args.processes))
+    print(f"spaCy pipeline loaded in {args.processes} processes")
+
+    anvil.server.connect(args.uplink_key)
+    print("Connected to Anvil server. Waiting for NLP calls...")
+    anvil.server.wait_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# simulate_gmail_push.py
+# Local stand-in for Gmail + Cloud Pub/Sub: posts push notifications to the app's
+# /gmail/push endpoint exactly as a Pub/Sub push subscription would.
+#
+# Example (3 notifications in a burst, plus one redelivery of the last one):
+#   python simulate_gmail_push.py --url https://<your-app>.anvil.app/_/api/gmail/push \
+#       --token <gmail_push_token> --history-id 123456 --burst 3 --redeliver
+import argparse
+import base64
+import datetime
+import json
+import time
+import urllib.parse
+import urllib.request
+
+def build_envelope(email_address, history_id, message_id):
+    """Builds the JSON body Pub/Sub sends for a Gmail watch notification."""
+    data = json.dumps({'emailAddress': email_address, 'historyId': history_id}).encode('UTF-8')
+    return {
+        'message': {
+            'data': base64.urlsafe_b64encode(data).decode('UTF-8'),
+            'messageId': str(message_id),
+            'publishTime': datetime.datetime.utcnow().isoformat() + 'Z'
+        },
+        'subscription': 'projects/local/subscriptions/gmail-push-simulator'
+    }
+
+def post_notification(url, token, envelope):
+    query = urllib.parse.urlencode({'token': token})
+    request = urllib.request.Request(
+        f"{url}?{query}",
+        data=json.dumps(envelope).encode('UTF-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+def main():
+    parser = argparse.ArgumentParser(description="Send simulated Gmail push notifications")
+    parser.add_argument('--url', required=True, help="Full URL of the /gmail/push endpoint")
+    parser.add_argument('--token', required=True, help="Value of the gmail_push_token secret")
+    parser.add_argument('--email', default='me@example.com', help="Mailbox address in the notification")
+    parser.add_argument('--history-id', type=int, required=True, help="historyId of the first notification")
+    parser.add_argument('--burst', type=int, default=1, help="Number of notifications to send back to back")
+    parser.add_argument('--interval', type=float, default=0.2, help="Seconds between notifications in a burst")
+    parser.add_argument('--redeliver', action='store_true', help="Resend the last notification, like a Pub/Sub retry")
+    args = parser.parse_args()
+
+    envelope = None
+    for i in range(args.burst):
+        envelope = build_envelope(args.email, args.history_id + i, 1000 + i)
+        status = post_notification(args.url, args.token, envelope)
+        print(f"Sent historyId {args.history_id + i}: HTTP {status}")
+        time.sleep(args.interval)
+
+    if args.redeliver and envelope is not None:
+        status = post_notification(args.url, args.token, envelope)
+        print(f"Redelivered last notification: HTTP {status}")
+
+if __name__ == '__main__':
+    main()
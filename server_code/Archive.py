@@ -0,0 +1,195 @@
+import anvil
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import datetime
+import functools
+import json
+
+# This module moves old newsletters out of the live tables (hot/cold tiering).
+#
+# Primary responsibilities:
+# 1. Finds newsletters older than the retention window in newsletters and
+#    newsletteroptimized
+# 2. Writes all of a newsletter's rows from those tables, with their full text, into a
+#    single compressed bundle in the newsletterarchive table
+# 3. Shrinks the live rows to summary rows: the body columns (the compressed columns
+#    of BodyStore.COMPRESSED_COLUMNS) are cleared and the rows are marked archived;
+#    a newsletter keeps only its newest newsletteroptimized row
+# 4. Serves archived bodies back to read paths (BodyStore.read_text falls through here),
+#    so callers asking for an old newsletter_id get the same text as before
+#
+# Only the body columns are cleared, because every read of them goes through
+# BodyStore.read_text. All other columns stay on the summary rows unchanged (subject,
+# sender, idempotency keys, key levels, trade plan, ...), so plain row reads keep
+# working for old IDs. The bodies are nearly all of a row's size.
+# newsletteranalysis holds no body and is left alone.
+#
+# Optional Anvil Secrets:
+# - archive_retention_days: newsletters older than this many days are archived
+#   (default DEFAULT_RETENTION_DAYS)
+#
+# Tables:
+# - newsletterarchive: one row per newsletter_id; the bundle is stored with
+#   BodyStore.compressed_columns('bundle', ...) as JSON {table name: [row dicts]}
+# - newsletters / newsletteroptimized.archived: marks summary rows
+
+RETENTION_SECRET = 'archive_retention_days'
+DEFAULT_RETENTION_DAYS = 180
+
+BUNDLE_COLUMN = 'bundle'
+
+# Tables whose rows are archived
+ARCHIVED_TABLES = ['newsletters', 'newsletteroptimized']
+
+# Archived bundles kept decompressed in memory by each server process
+BUNDLE_CACHE_SIZE = 8
+
+def retention_cutoff(retention_days=None, now=None):
+    """Returns the newsletter_id prefix (yyyymmdd) below which newsletters are archived."""
+    from . import utils
+    if retention_days is None:
+        retention_days = int(utils.get_optional_secret(RETENTION_SECRET, DEFAULT_RETENTION_DAYS))
+    now = now or datetime.datetime.now()
+    return (now - datetime.timedelta(days=retention_days)).strftime("%Y%m%d")
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+def _row_record(table_name, row):
+    """Returns a JSON-safe dict of a live row, with compressed text decompressed."""
+    from . import BodyStore
+    compressed_column = BodyStore.COMPRESSED_COLUMNS.get(table_name)
+    record = {}
+    for column, value in dict(row).items():
+        if compressed_column and column.startswith(f'{compressed_column}_'):
+            continue
+        if column == compressed_column:
+            value = BodyStore.read_text(row, column)
+        if isinstance(value, anvil.Media):
+            continue
+        record[column] = _json_value(value)
+    return record
+
+def _summary_values(table_name):
+    """Column values that turn a live row into a summary row: its body is cleared."""
+    from . import BodyStore
+    values = {'archived': True}
+    values.update(BodyStore.compressed_columns(BodyStore.COMPRESSED_COLUMNS[table_name], None))
+    return values
+
+def _newest_first(rows):
+    # Compared as ISO strings: some stored timestamps are raw date strings
+    return sorted(rows, key=lambda row: str(_json_value(row['timestamp']) or ''), reverse=True)
+
+@tables.in_transaction
+def archive_newsletter(newsletter_id):
+    """
+    Archives one newsletter: bundles its live rows into newsletterarchive and shrinks
+    them to summary rows. Rows already archived are skipped, and a bundle written by an
+    earlier run is extended rather than replaced, so re-running never loses data.
+    Returns the number of rows archived.
+    """
+    from . import BodyStore
+
+    archive = app_tables.newsletterarchive.get(newsletter_id=newsletter_id)
+    bundle = read_bundle(archive) if archive is not None else {}
+
+    archived_count = 0
+    for table_name in ARCHIVED_TABLES:
+        table = getattr(app_tables, table_name)
+        rows = _newest_first(table.search(q.not_(archived=True), newsletter_id=newsletter_id))
+        if not rows:
+            continue
+        bundle.setdefault(table_name, []).extend(_row_record(table_name, row) for row in rows)
+        summary = _summary_values(table_name)
+        for i, row in enumerate(rows):
+            # A single newsletteroptimized summary row is enough for the dashboard
+            if table_name == 'newsletteroptimized' and i > 0:
+                row.delete()
+            else:
+                row.update(**summary)
+        archived_count += len(rows)
+
+    if not archived_count:
+        return 0
+    values = dict(
+        archived_at=datetime.datetime.now(),
+        row_counts={table_name: len(records) for table_name, records in bundle.items()},
+        **BodyStore.compressed_columns(BUNDLE_COLUMN, json.dumps(bundle))
+    )
+    if archive is None:
+        app_tables.newsletterarchive.add_row(newsletter_id=newsletter_id, **values)
+    else:
+        archive.update(**values)
+    return archived_count
+
+def _archivable_ids(cutoff):
+    newsletter_ids = set()
+    for table_name in ARCHIVED_TABLES:
+        rows = getattr(app_tables, table_name).search(
+            q.fetch_only('newsletter_id'),
+            q.not_(archived=True),
+            newsletter_id=q.less_than(cutoff)
+        )
+        newsletter_ids.update(row['newsletter_id'] for row in rows if row['newsletter_id'])
+    return sorted(newsletter_ids)
+
+@anvil.server.callable
+@anvil.server.background_task
+def archive_old_newsletters(retention_days=None):
+    """
+    Archives every newsletter older than the retention window. Scheduled daily;
+    safe to re-run, since each newsletter is archived in its own transaction.
+    """
+    from . import HistoryAPI
+
+    cutoff = retention_cutoff(retention_days)
+    newsletter_ids = _archivable_ids(cutoff)
+    archived_rows = 0
+    for newsletter_id in newsletter_ids:
+        try:
+            archived_rows += archive_newsletter(newsletter_id)
+        except Exception as e:
+            print(f"Error archiving newsletter {newsletter_id}: {str(e)}")
+    if newsletter_ids:
+        HistoryAPI.invalidate_history_cache()
+    print(f"Archived {len(newsletter_ids)} newsletters older than {cutoff} ({archived_rows} rows)")
+    return {'cutoff': cutoff, 'newsletters': len(newsletter_ids), 'rows': archived_rows}
+
+@functools.lru_cache(maxsize=BUNDLE_CACHE_SIZE)
+def _decoded_bundle(newsletter_id, bundle_sha256):
+    # Keyed by content hash, so a bundle extended by a later run is never served stale
+    from . import BodyStore
+    archive = app_tables.newsletterarchive.get(newsletter_id=newsletter_id)
+    return json.loads(BodyStore.read_text(archive, BUNDLE_COLUMN))
+
+def read_bundle(archive):
+    """Returns a copy of the archived rows of a newsletterarchive row, {table name: [row dicts]}."""
+    bundle = _decoded_bundle(archive['newsletter_id'], archive[f'{BUNDLE_COLUMN}_sha256'])
+    return {table_name: list(records) for table_name, records in bundle.items()}
+
+def archived_rows(table_name, newsletter_id):
+    """Returns the archived rows of a newsletter in table_name, newest first."""
+    archive = app_tables.newsletterarchive.get(newsletter_id=newsletter_id)
+    if archive is None:
+        return []
+    records = read_bundle(archive).get(table_name, [])
+    return sorted(records, key=lambda record: str(record.get('timestamp') or ''), reverse=True)
+
+def archived_value(table_name, newsletter_id, column):
+    """Returns column from the newest archived row of a newsletter in table_name, or None."""
+    for record in archived_rows(table_name, newsletter_id):
+        return record.get(column)
+    return None
+
+def read_column(table_name, row, column):
+    """
+    Returns row[column], falling through to the archive when row is an archived
+    summary row whose body column was cleared. Used by BodyStore.read_text.
+    """
+    value = row[column]
+    if value is None and row['archived']:
+        return archived_value(table_name, row['newsletter_id'], column)
+    return value
@@ -0,0 +1,170 @@
+import anvil
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import hashlib
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# This module stores large newsletter texts compressed.
+#
+# Primary responsibilities:
+# 1. Compresses bodies with zstd (when the zstandard package is installed) or zlib
+# 2. Stores them in a Media column next to a SHA-256 content hash and the original length
+# 3. Decompresses only when the text is actually read
+# 4. Migrates rows written before compression and reports the storage reduction
+#
+# For a text column <col> the compressed form uses these columns:
+#   <col>_blob          Media     compressed bytes
+#   <col>_codec         string    'zstd' or 'zlib'
+#   <col>_sha256        string    hash of the UTF-8 text
+#   <col>_length        number    length of the UTF-8 text in bytes
+#   <col>_stored_length number    length of the compressed bytes
+# and <col> itself is left empty. Media columns are loaded lazily by Anvil, so table
+# searches that touch these rows no longer move the body at all.
+#
+# Compressed columns in use:
+#   newsletters.newsletterbody
+#   newsletteroptimized.optimized_content
+#   newsletterarchive.bundle (see Archive.py)
+#
+# Rows archived by Archive.py keep an empty <col>; read_text then reads the text
+# from the archive instead.
+
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+
+PREFERRED_CODEC = CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+
+COMPRESSED_COLUMNS = {
+    'newsletters': 'newsletterbody',
+    'newsletteroptimized': 'optimized_content',
+}
+
+# Live tables whose rows may be archived, by compressed column
+ARCHIVED_TABLES = {column: table_name for table_name, column in COMPRESSED_COLUMNS.items()}
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('UTF-8')).hexdigest()
+
+def compress_text(text, codec=PREFERRED_CODEC):
+    """Returns the compressed UTF-8 bytes of text."""
+    raw = text.encode('UTF-8')
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return zlib.compress(raw, ZLIB_LEVEL)
+
+def decompress_text(data, codec):
+    """Inverse of compress_text."""
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Body was stored with zstd but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data).decode('UTF-8')
+    return zlib.decompress(data).decode('UTF-8')
+
+def compressed_columns(column, text):
+    """
+    Returns the column values that store text compressed under column, ready to be
+    passed to add_row() or row.update().
+    """
+    if text is None:
+        return {
+            column: None,
+            f'{column}_blob': None,
+            f'{column}_codec': None,
+            f'{column}_sha256': None,
+            f'{column}_length': None,
+            f'{column}_stored_length': None,
+        }
+    data = compress_text(text)
+    return {
+        column: None,
+        f'{column}_blob': anvil.BlobMedia('application/octet-stream', data, name=f'{column}.{PREFERRED_CODEC}'),
+        f'{column}_codec': PREFERRED_CODEC,
+        f'{column}_sha256': content_hash(text),
+        f'{column}_length': len(text.encode('UTF-8')),
+        f'{column}_stored_length': len(data),
+    }
+
+def read_text(row, column):
+    """
+    Returns the text stored under column, decompressing it if necessary.
+    Rows written before compression are returned unchanged, and archived
+    summary rows fall through to the archive.
+    """
+    blob = row[f'{column}_blob']
+    if blob is None:
+        if column in ARCHIVED_TABLES:
+            from . import Archive
+            return Archive.read_column(ARCHIVED_TABLES[column], row, column)
+        return row[column]
+    text = decompress_text(blob.get_bytes(), row[f'{column}_codec'])
+    if content_hash(text) != row[f'{column}_sha256']:
+        raise ValueError(f"Stored {column} does not match its content hash")
+    return text
+
+def read_newsletter_body(newsletter_row):
+    return read_text(newsletter_row, 'newsletterbody')
+
+def read_optimized_content(optimized_row):
+    return read_text(optimized_row, 'optimized_content')
+
+@anvil.server.callable
+@anvil.server.background_task
+def compress_stored_bodies():
+    """
+    Compresses every row still holding its text uncompressed.
+    Returns the storage report for the whole archive afterwards.
+    """
+    for table_name, column in COMPRESSED_COLUMNS.items():
+        table = getattr(app_tables, table_name)
+        migrated = 0
+        for row in table.search(**{f'{column}_blob': None}):
+            text = row[column]
+            if not text:
+                continue
+            row.update(**compressed_columns(column, text))
+            migrated += 1
+        print(f"Compressed {migrated} rows in {table_name}.{column}")
+    return storage_report()
+
+@anvil.server.callable
+def storage_report():
+    """
+    Reports original vs stored size for every compressed column.
+    Rows that are still uncompressed are counted at their original size.
+    """
+    report = {}
+    for table_name, column in COMPRESSED_COLUMNS.items():
+        table = getattr(app_tables, table_name)
+        rows = compressed = original_bytes = stored_bytes = 0
+        for row in table.search(q.fetch_only(column, f'{column}_length', f'{column}_stored_length')):
+            rows += 1
+            if row[f'{column}_length'] is not None:
+                compressed += 1
+                original_bytes += row[f'{column}_length']
+                stored_bytes += row[f'{column}_stored_length']
+            elif row[column]:
+                size = len(str(row[column]).encode('UTF-8'))
+                original_bytes += size
+                stored_bytes += size
+        saved = original_bytes - stored_bytes
+        report[f'{table_name}.{column}'] = {
+            'rows': rows,
+            'compressed_rows': compressed,
+            'original_bytes': original_bytes,
+            'stored_bytes': stored_bytes,
+            'saved_bytes': saved,
+            'reduction_pct': round(100.0 * saved / original_bytes, 1) if original_bytes else 0.0
+        }
+        print(f"{table_name}.{column}: {original_bytes} -> {stored_bytes} bytes "
+              f"({report[f'{table_name}.{column}']['reduction_pct']}% smaller, {compressed}/{rows} rows compressed)")
+    return report
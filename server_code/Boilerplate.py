@@ -0,0 +1,248 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import datetime
+import hashlib
+import re
+
+# This module learns which paragraphs are boilerplate from the stored newsletters,
+# instead of relying only on the hand-maintained regexes in OptimizeNewsletter.clean_text.
+#
+# Primary responsibilities:
+# 1. Fingerprints every paragraph with a MinHash signature over its word shingles
+# 2. Counts, per LSH band of that signature, how many newsletters contain it
+# 3. Strips paragraphs whose bands recur in most newsletters in one pass
+# 4. Refreshes the counts incrementally as new newsletters are stored
+#
+# MinHash makes near-identical paragraphs (a disclaimer with a changed date or link
+# text) share most band keys, so they are recognised as the same recurring block.
+# Paragraphs carrying a section header or key level lines are never stripped, even
+# though unchanged core levels recur across issues.
+#
+# A band's count is compared with the issues indexed since the band was first seen,
+# not with the whole archive, so a disclaimer added to a long-running newsletter is
+# stripped after a few issues rather than after the archive has doubled.
+#
+# Every sender has its own model (named after its sender key, 'default' for the primary
+# sender), since each newsletter has its own recurring disclaimers.
+#
+# Tables:
+# - boilerplatefingerprints: one row per (model, band key) with the number of newsletters
+#   containing it and the model's document number when it was first seen (first_document)
+# - boilerplatemodel: one row per model holding the number of newsletters indexed
+# - newsletters.boilerplate_indexed: marks newsletters already counted in the model
+
+MODEL_NAME = 'default'
+
+SHINGLE_SIZE = 4
+NUM_HASHES = 16
+BANDS = 4
+ROWS_PER_BAND = NUM_HASHES // BANDS
+
+# Fraction of the newsletters indexed since a band was first seen that must contain it
+# for the band to count as boilerplate
+BOILERPLATE_THRESHOLD = 0.6
+# Bands (out of BANDS) that must be boilerplate for a paragraph to be stripped
+MIN_MATCHING_BANDS = 2
+# The model is not applied until this many newsletters have been indexed, and a band is
+# always judged over at least this many newsletters
+MIN_DOCUMENTS = 5
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_HASH_PARAMS = [
+    (int.from_bytes(hashlib.sha256(f"a{i}".encode()).digest()[:8], 'big') % _MERSENNE_PRIME or 1,
+     int.from_bytes(hashlib.sha256(f"b{i}".encode()).digest()[:8], 'big') % _MERSENNE_PRIME)
+    for i in range(NUM_HASHES)
+]
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def split_paragraphs(text):
+    """Splits text into paragraphs at blank lines."""
+    return [p for p in re.split(r"\n\s*\n", text) if p.strip()]
+
+def _shingles(paragraph):
+    words = re.findall(r"\w+", paragraph.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def band_keys(paragraph):
+    """Returns the LSH band keys of a paragraph's MinHash signature."""
+    shingles = _shingles(paragraph)
+    if not shingles:
+        return []
+    hashed = [int.from_bytes(hashlib.blake2b(s.encode('UTF-8'), digest_size=8).digest(), 'big') for s in shingles]
+    signature = [min((a * h + b) % _MERSENNE_PRIME for h in hashed) for a, b in _HASH_PARAMS]
+    keys = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(",".join(map(str, rows)).encode('UTF-8'), digest_size=8).hexdigest()
+        keys.append(f"{band}:{digest}")
+    return keys
+
+def _is_protected(paragraph):
+    """Paragraphs with section headers or key level lines are content, however often they recur."""
+    from . import SectionDiff
+    for line in paragraph.splitlines():
+        stripped = line.strip()
+        if SectionDiff.SECTION_HEADER_PATTERN.match(stripped):
+            return True
+        if stripped and stripped[0].isdigit():
+            return True
+    return False
+
+def count_tokens(text):
+    """Approximate token count (words and punctuation marks)."""
+    return len(_TOKEN_PATTERN.findall(text))
+
+def _get_model_row(model_name):
+    model = app_tables.boilerplatemodel.get(name=model_name)
+    if model is None:
+        model = app_tables.boilerplatemodel.add_row(name=model_name, documents=0, updated=datetime.datetime.now())
+    return model
+
+def is_boilerplate_band(doc_count, first_document, documents):
+    """
+    True when a band is in at least BOILERPLATE_THRESHOLD of the newsletters indexed
+    since it was first seen (document number first_document of documents).
+    """
+    documents_since = documents - (first_document or 1) + 1
+    return doc_count >= BOILERPLATE_THRESHOLD * max(documents_since, MIN_DOCUMENTS)
+
+def load_model(model_name=MODEL_NAME):
+    """
+    Returns the set of band keys that currently count as boilerplate, or an empty
+    set while fewer than MIN_DOCUMENTS newsletters have been indexed.
+    """
+    documents = _get_model_row(model_name)['documents'] or 0
+    if documents < MIN_DOCUMENTS:
+        return set()
+    # No band seen in fewer newsletters than this can count, whenever it was first seen
+    rows = app_tables.boilerplatefingerprints.search(
+        q.fetch_only('band_key', 'doc_count', 'first_document'),
+        model=model_name,
+        doc_count=q.greater_than_equal(BOILERPLATE_THRESHOLD * MIN_DOCUMENTS)
+    )
+    return {
+        row['band_key'] for row in rows
+        if is_boilerplate_band(row['doc_count'], row['first_document'], documents)
+    }
+
+def strip_boilerplate(text, boilerplate_keys=None, model_name=MODEL_NAME):
+    """
+    Removes recurring boilerplate paragraphs from text in one pass.
+    Returns (stripped_text, stats) where stats reports what was removed.
+    """
+    if boilerplate_keys is None:
+        boilerplate_keys = load_model(model_name)
+
+    kept = []
+    removed = []
+    for paragraph in split_paragraphs(text):
+        matches = sum(1 for key in band_keys(paragraph) if key in boilerplate_keys)
+        if matches >= MIN_MATCHING_BANDS and not _is_protected(paragraph):
+            removed.append(paragraph)
+        else:
+            kept.append(paragraph)
+
+    stripped = "\n\n".join(p.strip('\n') for p in kept) if removed else text
+    stats = {
+        'paragraphs_removed': len(removed),
+        'bytes_removed': len(text.encode('UTF-8')) - len(stripped.encode('UTF-8')),
+        'tokens_removed': count_tokens(text) - count_tokens(stripped),
+    }
+    if removed:
+        print(f"Boilerplate removed: {stats['paragraphs_removed']} paragraphs, "
+              f"{stats['bytes_removed']} bytes, ~{stats['tokens_removed']} tokens")
+    return stripped, stats
+
+def index_newsletter(newsletter_row, cleaned_text, model_name=MODEL_NAME):
+    """
+    Adds one newsletter's paragraphs to the model. Each band key is counted at most
+    once per newsletter. Does nothing if the newsletter was already indexed.
+    """
+    if newsletter_row['boilerplate_indexed']:
+        return False
+
+    keys = {}
+    for paragraph in split_paragraphs(cleaned_text):
+        for key in band_keys(paragraph):
+            keys.setdefault(key, paragraph)
+    _add_document(newsletter_row, keys, model_name)
+    return True
+
+@tables.in_transaction
+def _add_document(newsletter_row, keys, model_name):
+    """
+    Counts a newsletter's band keys ({band key: paragraph}) into the model. Existing
+    fingerprints are read in one search and new ones written with one add_rows; the
+    counts, the document count and the indexed flag change in one transaction, so a
+    failed run leaves nothing to be counted twice on retry.
+    """
+    newsletter_id = newsletter_row['newsletter_id']
+    document = _count_document(model_name)
+    existing = {}
+    if keys:
+        rows = app_tables.boilerplatefingerprints.search(model=model_name, band_key=q.any_of(*keys))
+        existing = {row['band_key']: row for row in rows}
+
+    new_rows = []
+    for key, paragraph in keys.items():
+        row = existing.get(key)
+        if row is None:
+            new_rows.append(dict(
+                model=model_name,
+                band_key=key,
+                doc_count=1,
+                first_document=document,
+                last_newsletter_id=newsletter_id,
+                sample=paragraph[:200]
+            ))
+        else:
+            row.update(doc_count=(row['doc_count'] or 0) + 1, last_newsletter_id=newsletter_id)
+    if new_rows:
+        app_tables.boilerplatefingerprints.add_rows(new_rows)
+    newsletter_row['boilerplate_indexed'] = True
+
+def _count_document(model_name):
+    """Counts one more newsletter into the model and returns its document number. Call inside a transaction."""
+    model = _get_model_row(model_name)
+    documents = (model['documents'] or 0) + 1
+    model.update(documents=documents, updated=datetime.datetime.now())
+    return documents
+
+@anvil.server.callable
+@anvil.server.background_task
+def refresh_boilerplate_model():
+    """
+    Indexes every stored newsletter that is not yet part of its sender's model, oldest
+    first, so document numbers follow publication order.
+    """
+    from . import BodyStore, OptimizeNewsletter, Senders, utils
+
+    indexed = 0
+    models = set()
+    for newsletter in app_tables.newsletters.search(
+        tables.order_by('newsletter_id'),
+        q.not_(boilerplate_indexed=True)
+    ):
+        body = BodyStore.read_newsletter_body(newsletter)
+        if not body:
+            continue
+        sender_key = utils.sender_key_of(newsletter['newsletter_id'])
+        sender = Senders.get_sender(sender_key)
+        model_name = sender_key or MODEL_NAME
+        cleaned = OptimizeNewsletter.clean_newsletter_text(body, sender['cleaning_profile'])
+        if index_newsletter(newsletter, cleaned, model_name):
+            indexed += 1
+            models.add(model_name)
+    print(f"Boilerplate models refreshed: {indexed} newsletters added to {sorted(models)}")
+    return {
+        'indexed': indexed,
+        'models': {
+            row['name']: {'documents': row['documents'], 'boilerplate_bands': len(load_model(row['name']))}
+            for row in app_tables.boilerplatemodel.search()
+        }
+    }
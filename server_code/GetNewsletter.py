@@ -12,6 +12,9 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+import google_auth_httplib2
+import httplib2
+import threading
 import base64
 from email.mime.text import MIMEText
 import json
@@ -47,6 +50,9 @@ from email.utils import parsedate_to_datetime
 # - google_refresh_token: For Gmail API authentication
 # - newsletter_sender_email: Email address to identify the newsletter
 
+# Returned by _get_latest_newsletter, with the stored newsletter_id, for an email already stored
+DUPLICATE = "DUPLICATE"
+
 def find_body(payload):
     """Recursively search the payload for a body with data."""
     if 'body' in payload and 'data' in payload['body']:
@@ -58,33 +64,78 @@ def find_body(payload):
                 return result
     return None
 
-def get_gmail_service():
+def get_gmail_credentials():
+    """Creates and refreshes OAuth credentials from our Anvil secrets."""
+    creds = Credentials(
+        token=None,
+        refresh_token=anvil.secrets.get_secret('google_refresh_token'),
+        client_id=anvil.secrets.get_secret('google_client_id'),
+        client_secret=anvil.secrets.get_secret('google_client_secret'),
+        token_uri='https://oauth2.googleapis.com/token',
+        scopes=['https://www.googleapis.com/auth/gmail.readonly', 
+               'https://www.googleapis.com/auth/gmail.send']
+    )
+    
+    # Refresh the credentials
+    creds.refresh(Request())
+    return creds
+
+def get_gmail_service(credentials=None):
     """
     Creates and returns an authenticated Gmail service using our OAuth credentials.
     Similar to the non-Anvil version but using Anvil secrets instead of local files.
     """
     try:
-        # Create credentials from our Anvil secrets
-        creds = Credentials(
-            token=None,
-            refresh_token=anvil.secrets.get_secret('google_refresh_token'),
-            client_id=anvil.secrets.get_secret('google_client_id'),
-            client_secret=anvil.secrets.get_secret('google_client_secret'),
-            token_uri='https://oauth2.googleapis.com/token',
-            scopes=['https://www.googleapis.com/auth/gmail.readonly', 
-                   'https://www.googleapis.com/auth/gmail.send']
-        )
-        
-        # Refresh the credentials
-        creds.refresh(Request())
+        if credentials is None:
+            credentials = get_gmail_credentials()
         
         # Return the Gmail service
-        return build('gmail', 'v1', credentials=creds)
+        return build('gmail', 'v1', credentials=credentials)
         
     except Exception as e:
         print(f"Error creating Gmail service: {str(e)}")
         raise
 
+_thread_local = threading.local()
+
+def _execute(request, credentials=None):
+    """
+    Executes a Gmail API request. When credentials are given, the request goes over an
+    HTTP connection owned by the current thread: httplib2 is not thread-safe, so this is
+    how worker threads share one Gmail service object and one set of credentials.
+    """
+    if credentials is None:
+        return request.execute()
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        _thread_local.http = http
+    return request.execute(http=http)
+
+def fetch_latest_message(service, sender, credentials=None):
+    """
+    Finds and downloads the most recent email matching sender's query.
+    Returns the full Gmail message, or None if there is none.
+    """
+    print(f"Looking for emails from {sender['name']} with query: {sender['query']}")
+    results = _execute(service.users().messages().list(
+        userId='me',
+        q=sender['query'],
+        maxResults=1
+    ), credentials)
+
+    messages = results.get('messages', [])
+    if not messages:
+        print(f"No emails found for sender {sender['name']}")
+        return None
+
+    # Get the full email content
+    return _execute(service.users().messages().get(
+        userId='me',
+        id=messages[0]['id'],
+        format='full'
+    ), credentials)
+
 def get_newsletter_id(session_date=None):
     """
     Generates a newsletter ID in yyyymmdd format for the next trading day.
@@ -121,35 +172,38 @@ def get_newsletter_id(session_date=None):
     next_trading_day = current_date + datetime.timedelta(days=days_to_add)
     return next_trading_day.strftime("%Y%m%d"), next_trading_day
 
-def _get_latest_newsletter():
-    """Synchronous helper function to retrieve the newsletter."""
+def _get_latest_newsletter(message_id=None, sender=None, message=None, newsletter_id=None):
+    """
+    Synchronous helper function to retrieve the newsletter.
+    When message_id is given (e.g. from a Gmail push notification) that message is
+    ingested directly instead of searching for the sender's latest email. When message
+    is given it has already been downloaded by an ingestion worker.
+    sender defaults to the primary sender of the Senders registry.
+    
+    Returns the stored newsletter, None when there is nothing to store, or
+    (DUPLICATE, newsletter_id) when the email was already stored under newsletter_id.
+    """
     try:
+        from . import Senders
         print("Starting newsletter retrieval process")
-        sender_email = anvil.secrets.get_secret('newsletter_sender_email')
-        print(f"Looking for emails from: {sender_email}")
-
-        service = get_gmail_service()
+        if sender is None:
+            sender = Senders.primary_sender()
 
-        # Search for the most recent email from the sender
-        query = f"from:{sender_email}"
-        results = service.users().messages().list(
-            userId='me',
-            q=query,
-            maxResults=1
-        ).execute()
-
-        messages = results.get('messages', [])
-
-        if not messages:
-            print("No emails found from the specified sender")
-            return None
-
-        # Get the full email content
-        msg = service.users().messages().get(
-            userId='me',
-            id=messages[0]['id'],
-            format='full'
-        ).execute()
+        if message is not None:
+            msg = message
+        elif message_id is None:
+            msg = fetch_latest_message(get_gmail_service(), sender)
+            if msg is None:
+                return None
+        else:
+            print(f"Retrieving Gmail message: {message_id}")
+            # Get the full email content
+            msg = get_gmail_service().users().messages().get(
+                userId='me',
+                id=message_id,
+                format='full'
+            ).execute()
+        message_id = msg['id']
 
         # Extract headers
         headers = msg['payload']['headers']
@@ -157,13 +211,22 @@ def _get_latest_newsletter():
         date = next(h['value'] for h in headers if h['name'].lower() == 'date')
 
         # Check for duplicates BEFORE processing the email body
-        latest_rows = list(app_tables.newsletters.search())
-        if latest_rows:
-            latest = sorted(latest_rows, key=lambda row: row['timestamp'], reverse=True)[0]
+        from . import BodyStore, HistoryAPI, HtmlText, RunLock, SearchIndex
+        newsletter_key = f"newsletter:{message_id}"
+        existing = app_tables.newsletters.get(idempotency_key=newsletter_key)
+        if existing is not None:
+            print(f"Duplicate email detected. Gmail message {message_id} has already been stored.")
+            return DUPLICATE, existing['newsletter_id']
+        latest_rows = app_tables.newsletters.search(
+            tables.order_by('timestamp', ascending=False),
+            sender=Senders.sender_key(sender)
+        )
+        latest = next(iter(latest_rows), None)
+        if latest is not None:
             if latest['newslettersubject'] == subject:
                 print("Duplicate email detected. Latest email subject matches the retrieved email subject.")
                 print("Stopping all processing to prevent duplicate entries.")
-                return "DUPLICATE"
+                return DUPLICATE, latest['newsletter_id']
 
         # Extract body only if not a duplicate
         body = find_body(msg['payload'])
@@ -177,17 +240,29 @@ def _get_latest_newsletter():
             print("Error parsing date, storing raw date string:", e)
             news_timestamp = date
 
-        newsletter_id, _ = get_newsletter_id()  # Only use the ID part
-        app_tables.newsletters.add_row(
+        if newsletter_id is None:
+            base_newsletter_id, _ = get_newsletter_id()  # Only use the ID part
+            newsletter_id = Senders.newsletter_id_for(base_newsletter_id, sender)
+        row, created = RunLock.add_row_once(
+            app_tables.newsletters,
+            newsletter_key,
             newsletter_id=newsletter_id,
+            gmail_message_id=message_id,
+            sender=Senders.sender_key(sender),
             timestamp=news_timestamp,
             newslettersubject=subject,
-            newsletterbody=body
+            **BodyStore.compressed_columns('newsletterbody', body)
         )
+        if not created:
+            print(f"Gmail message {message_id} was stored by a concurrent run")
+            return DUPLICATE, row['newsletter_id']
         print("Newsletter row inserted into app_tables.newsletters")
+        HistoryAPI.invalidate_history_cache()
+        SearchIndex.index_newsletter(newsletter_id, HtmlText.body_text(body), 'original')
         print("Newsletter content being returned")
         
         return {
+            'newsletter_id': newsletter_id,
             'subject': subject,
             'body': body,
             'date': date
@@ -200,19 +275,15 @@ def _get_latest_newsletter():
 @anvil.server.callable
 @anvil.server.background_task
 def get_latest_newsletter():
-    result = _get_latest_newsletter()
-    if result is None:
-        print("No new newsletter found.")
-        return "No new newsletter to process."
-    elif result == "DUPLICATE":
-        print("Duplicate newsletter detected, stopping all processing.")
-        return "Duplicate newsletter detected."
-    else:
-        print("Newsletter processed successfully.")
-        # Chain the optimization task after successful retrieval
-        print("Launching optimization task...")
-        anvil.server.launch_background_task('optimize_latest_newsletter')
-        return "Newsletter retrieved and optimization task launched."
+    """
+    Retrieves the latest newsletter and runs the rest of the pipeline for it.
+    Goes through Main._process_newsletter so a manual retrieval takes the same
+    per-newsletter lease as the scheduled run and can never overlap with it.
+    """
+    from . import Main
+    result = Main._process_newsletter()
+    print(result['message'])
+    return result['message']
 
 @anvil.server.callable
 def start_newsletter_retrieval():
@@ -0,0 +1,300 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.secrets
+import anvil.server
+import base64
+import datetime
+import json
+import time
+
+# This module ingests newsletters as soon as Gmail tells us a message has arrived,
+# instead of waiting for the scheduled process_newsletter poll.
+#
+# Primary responsibilities:
+# 1. Registers a Gmail watch that publishes mailbox changes to a Cloud Pub/Sub topic
+# 2. Exposes an HTTP endpoint that receives the Pub/Sub push notifications
+# 3. Coalesces duplicate notifications and debounces bursts into a single worker run
+# 4. Runs the ingest (and the rest of the pipeline) for each new newsletter message
+#
+# Flow:
+#   Gmail -> Pub/Sub push -> POST {origin}/_/api/gmail/push?token=... -> gmailpushstate row
+#   -> process_gmail_push background task -> history.list -> Main._process_newsletter(message_id)
+#
+# Pub/Sub delivers at-least-once, so the same historyId can arrive several times and a
+# single email can trigger several notifications. Notifications never start work directly:
+# they only raise the pending historyId. At most one worker runs at a time and it keeps
+# looping until no newer notification is pending.
+#
+# The scheduled process_newsletter task stays in anvil.yaml as a slow safety net for
+# notifications that are lost or arrive while the watch has lapsed.
+#
+# local_tools/simulate_gmail_push.py posts fake notifications to the endpoint for testing.
+#
+# Required Anvil Secrets:
+# - gmail_pubsub_topic: Full Pub/Sub topic name, e.g. projects/<project>/topics/<topic>
+# - gmail_push_token: Shared token appended to the push subscription URL
+# - newsletter_sender_email: Email address to identify the newsletter (when no
+#   senders are registered in the newslettersenders table, see Senders.py)
+
+STATE_NAME = 'gmail'
+
+# Seconds the worker waits after the first notification so a burst is handled in one pass
+DEBOUNCE_SECONDS = 10
+
+# A worker that has not updated its heartbeat for this long is assumed dead
+WORKER_STALE_SECONDS = 15 * 60
+
+def _now():
+    return datetime.datetime.now()
+
+def decode_notification(envelope):
+    """
+    Decodes a Pub/Sub push envelope into the Gmail notification it carries.
+    Returns a dict with 'emailAddress' and 'historyId' (as an int).
+    """
+    message = (envelope or {}).get('message') or {}
+    data = message.get('data')
+    if not data:
+        raise ValueError("Push envelope has no message data")
+    notification = json.loads(base64.urlsafe_b64decode(data.encode('UTF-8')).decode('UTF-8'))
+    return {
+        'emailAddress': notification.get('emailAddress'),
+        'historyId': int(notification['historyId'])
+    }
+
+def _get_state():
+    state = app_tables.gmailpushstate.get(name=STATE_NAME)
+    if state is None:
+        state = app_tables.gmailpushstate.add_row(
+            name=STATE_NAME,
+            history_id=None,
+            pending_history_id=None,
+            dirty=False,
+            worker_running=False,
+            worker_heartbeat=None,
+            last_notification=None,
+            notifications_received=0,
+            notifications_coalesced=0,
+            watch_expiration=None
+        )
+    return state
+
+def _worker_alive(state):
+    if not state['worker_running'] or state['worker_heartbeat'] is None:
+        return False
+    age = (_now() - state['worker_heartbeat'].replace(tzinfo=None)).total_seconds()
+    return age < WORKER_STALE_SECONDS
+
+@tables.in_transaction
+def _record_notification(history_id):
+    """
+    Records a notification. Returns True when the caller should launch a worker,
+    False when the notification was a duplicate or a live worker will pick it up.
+    """
+    state = _get_state()
+    state['notifications_received'] = (state['notifications_received'] or 0) + 1
+    state['last_notification'] = _now()
+
+    if history_id <= (state['history_id'] or 0):
+        # Redelivered or out-of-order notification; already processed
+        state['notifications_coalesced'] = (state['notifications_coalesced'] or 0) + 1
+        return False
+
+    state['pending_history_id'] = max(history_id, state['pending_history_id'] or 0)
+    state['dirty'] = True
+    if _worker_alive(state):
+        # The running worker re-checks the pending historyId before it exits
+        state['notifications_coalesced'] = (state['notifications_coalesced'] or 0) + 1
+        return False
+
+    state['worker_running'] = True
+    state['worker_heartbeat'] = _now()
+    return True
+
+@tables.in_transaction
+def _claim_pending():
+    """Takes the pending work. Returns (start_history_id, target_history_id)."""
+    state = _get_state()
+    state['dirty'] = False
+    state['worker_heartbeat'] = _now()
+    return state['history_id'], state['pending_history_id']
+
+@tables.in_transaction
+def _mark_processed(history_id):
+    state = _get_state()
+    if history_id is not None and history_id > (state['history_id'] or 0):
+        state['history_id'] = history_id
+    state['worker_heartbeat'] = _now()
+
+@tables.in_transaction
+def _worker_heartbeat():
+    """Keeps the worker marked alive while it ingests, so no second worker is launched."""
+    _get_state()['worker_heartbeat'] = _now()
+
+@tables.in_transaction
+def _release_worker():
+    """Stops the worker unless a notification arrived while it was busy. Returns True if it stopped."""
+    state = _get_state()
+    if state['dirty']:
+        state['worker_heartbeat'] = _now()
+        return False
+    state['worker_running'] = False
+    state['worker_heartbeat'] = None
+    return True
+
+def _sender_of_message(service, message_id):
+    """Returns the registered sender of a message, checking its From header without downloading the body."""
+    from . import Senders
+    msg = service.users().messages().get(
+        userId='me',
+        id=message_id,
+        format='metadata',
+        metadataHeaders=['From']
+    ).execute()
+    headers = msg.get('payload', {}).get('headers', [])
+    from_header = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+    return Senders.sender_for_message(from_header)
+
+def _new_message_ids(service, start_history_id):
+    """
+    Returns the IDs of messages added to the inbox since start_history_id, oldest first.
+    Returns None when the history is unavailable and the caller should fall back to
+    retrieving the latest newsletter.
+    """
+    if start_history_id is None:
+        return None
+    message_ids = []
+    page_token = None
+    try:
+        while True:
+            response = service.users().history().list(
+                userId='me',
+                startHistoryId=int(start_history_id),
+                historyTypes=['messageAdded'],
+                labelId='INBOX',
+                pageToken=page_token
+            ).execute()
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message_id = added['message']['id']
+                    if message_id not in message_ids:
+                        message_ids.append(message_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+    except Exception as e:
+        # Gmail returns 404 when startHistoryId is too old
+        print(f"Could not list Gmail history since {start_history_id}: {str(e)}")
+        return None
+    return message_ids
+
+def _ingest_since(start_history_id):
+    """Runs the newsletter workflow for every new newsletter message since start_history_id."""
+    from . import GetNewsletter, Main
+
+    service = GetNewsletter.get_gmail_service()
+    message_ids = _new_message_ids(service, start_history_id)
+    if message_ids is None:
+        print("No usable history checkpoint, processing the latest newsletter instead")
+        _worker_heartbeat()
+        return [Main._process_all_senders()]
+
+    results = []
+    for message_id in message_ids:
+        # Each ingest runs the whole pipeline, which can take minutes
+        _worker_heartbeat()
+        sender = _sender_of_message(service, message_id)
+        if sender is None:
+            continue
+        print(f"New newsletter message {message_id} from {sender['name']}, starting ingest")
+        results.append(Main._process_newsletter(message_id, sender))
+    if not results:
+        print("Notification did not contain any new newsletter messages")
+    return results
+
+@anvil.server.background_task
+def process_gmail_push():
+    """
+    Debounced worker launched by the push endpoint. Processes every pending
+    notification, then exits once no newer notification has arrived.
+    """
+    results = []
+    try:
+        while True:
+            time.sleep(DEBOUNCE_SECONDS)
+            start_history_id, target_history_id = _claim_pending()
+            print(f"Processing Gmail changes from history {start_history_id} to {target_history_id}")
+            results.extend(_ingest_since(start_history_id))
+            _mark_processed(target_history_id)
+            if _release_worker():
+                break
+    except Exception as e:
+        print(f"Error processing Gmail push notifications: {str(e)}")
+        _force_release_worker()
+        raise
+    return results
+
+@tables.in_transaction
+def _force_release_worker():
+    state = _get_state()
+    state['worker_running'] = False
+    state['worker_heartbeat'] = None
+
+@anvil.server.http_endpoint("/gmail/push", methods=["POST"])
+def gmail_push(**params):
+    """
+    Receives Gmail watch notifications delivered by a Pub/Sub push subscription.
+    Always acknowledges quickly; the actual ingest runs in a background task.
+    """
+    expected_token = anvil.secrets.get_secret('gmail_push_token')
+    if params.get('token') != expected_token:
+        return anvil.server.HttpResponse(403, "Invalid token")
+
+    try:
+        notification = decode_notification(anvil.server.request.body_json)
+    except Exception as e:
+        # Acknowledge malformed messages so Pub/Sub does not redeliver them forever
+        print(f"Ignoring malformed push notification: {str(e)}")
+        return anvil.server.HttpResponse(204)
+
+    print(f"Gmail notification for {notification['emailAddress']}, historyId {notification['historyId']}")
+    if _record_notification(notification['historyId']):
+        anvil.server.launch_background_task('process_gmail_push')
+    return anvil.server.HttpResponse(204)
+
+@anvil.server.callable
+def start_gmail_watch():
+    """
+    Registers (or renews) the Gmail watch on the inbox. Gmail expires watches after
+    seven days, so renew_gmail_watch re-registers it every day.
+    """
+    from . import GetNewsletter
+
+    service = GetNewsletter.get_gmail_service()
+    response = service.users().watch(
+        userId='me',
+        body={
+            'topicName': anvil.secrets.get_secret('gmail_pubsub_topic'),
+            'labelIds': ['INBOX'],
+            'labelFilterBehavior': 'include'
+        }
+    ).execute()
+
+    expiration = datetime.datetime.fromtimestamp(int(response['expiration']) / 1000)
+    _store_watch(int(response['historyId']), expiration)
+    print(f"Gmail watch active until {expiration}, historyId {response['historyId']}")
+    return {'historyId': response['historyId'], 'expiration': expiration}
+
+@tables.in_transaction
+def _store_watch(history_id, expiration):
+    state = _get_state()
+    state['watch_expiration'] = expiration
+    if state['history_id'] is None:
+        # First registration: only changes after this point are of interest
+        state['history_id'] = history_id
+
+@anvil.server.background_task
+def renew_gmail_watch():
+    """Scheduled task that keeps the Gmail watch from expiring."""
+    return start_gmail_watch()
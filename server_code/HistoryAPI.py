@@ -0,0 +1,173 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import datetime
+
+# This module serves newsletter history to the client dashboard.
+#
+# Primary responsibilities:
+# 1. Pages through newsletters newest-first with an opaque cursor, one entry per
+#    newsletter_id (some legacy days have more than one newsletters row; the latest
+#    one is listed, as get_newsletter_text serves it)
+# 2. Projects only the columns the list needs (ID, date, subject, levels summary),
+#    so no newsletter body ever travels to the browser with a page
+# 3. Fetches the full original or optimized text separately, on demand
+# 4. Caches recently served pages in the historypagecache table
+#
+# A page is a single server call, so the dashboard loads in one small round trip.
+# The cache is cleared whenever a newsletter is stored or optimized, and entries
+# also expire after CACHE_TTL_SECONDS.
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# How many levels are included in a page entry's levels summary
+SUMMARY_LEVELS = 5
+
+CACHE_TTL_SECONDS = 10 * 60
+
+def _cache_key(cursor, page_size):
+    return f"{cursor or ''}|{page_size}"
+
+def _cached_page(cache_key):
+    rows = list(app_tables.historypagecache.search(
+        tables.order_by('created', ascending=False),
+        cache_key=cache_key
+    ))
+    if not rows:
+        return None
+    row = rows[0]
+    for duplicate in rows[1:]:
+        # Left by a cache write from before _store_page ran in a transaction
+        duplicate.delete()
+    age = (datetime.datetime.now() - row['created'].replace(tzinfo=None)).total_seconds()
+    if age > CACHE_TTL_SECONDS:
+        row.delete()
+        return None
+    return row['page']
+
+@tables.in_transaction
+def _store_page(cache_key, page):
+    row = app_tables.historypagecache.get(cache_key=cache_key)
+    if row is None:
+        app_tables.historypagecache.add_row(cache_key=cache_key, page=page, created=datetime.datetime.now())
+    else:
+        row.update(page=page, created=datetime.datetime.now())
+
+def invalidate_history_cache():
+    """Drops every cached page. Called whenever a newsletter is stored or optimized."""
+    for row in app_tables.historypagecache.search():
+        row.delete()
+
+def _iso_date(value):
+    """Dates are sent as ISO strings so a page can be stored in a simpleObject cache column."""
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+def _levels_summaries(newsletter_ids):
+    """Returns {newsletter_id: levels summary} for the given IDs, from newsletteroptimized."""
+    summaries = {}
+    if not newsletter_ids:
+        return summaries
+    rows = app_tables.newsletteroptimized.search(
+        q.fetch_only('newsletter_id', 'keylevelsraw', 'levels_added', 'levels_removed', 'timestamp'),
+        tables.order_by('timestamp', ascending=True),
+        newsletter_id=q.any_of(*newsletter_ids)
+    )
+    for row in rows:
+        # Later rows win, so a re-optimized newsletter shows its latest levels
+        levels = [level for level in (row['keylevelsraw'] or '').splitlines() if level]
+        summaries[row['newsletter_id']] = {
+            'count': len(levels),
+            'levels': levels[:SUMMARY_LEVELS],
+            'added': len([level for level in (row['levels_added'] or '').splitlines() if level]),
+            'removed': len([level for level in (row['levels_removed'] or '').splitlines() if level]),
+        }
+    return summaries
+
+@anvil.server.callable
+def get_newsletter_history_page(cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Returns one page of newsletter history, newest first:
+      {'items': [{'newsletter_id', 'date', 'subject', 'levels_summary'}, ...],
+       'next_cursor': <pass back to get the next page, or None on the last page>}
+    """
+    page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+    cache_key = _cache_key(cursor, page_size)
+    page = _cached_page(cache_key)
+    if page is not None:
+        return page
+
+    filters = {}
+    if cursor:
+        filters['newsletter_id'] = q.less_than(cursor)
+    rows = app_tables.newsletters.search(
+        q.fetch_only('newsletter_id', 'timestamp', 'newslettersubject'),
+        tables.order_by('newsletter_id', ascending=False),
+        tables.order_by('timestamp', ascending=False),
+        **filters
+    )
+
+    # Duplicate newsletter_id rows are collapsed before paging, so the cursor (the last
+    # newsletter_id of the page) never splits them across pages. One extra newsletter
+    # is fetched to know whether another page exists.
+    page_rows = []
+    for row in rows:
+        if page_rows and page_rows[-1]['newsletter_id'] == row['newsletter_id']:
+            continue
+        page_rows.append(row)
+        if len(page_rows) > page_size:
+            break
+    has_more = len(page_rows) > page_size
+    rows = page_rows[:page_size]
+
+    summaries = _levels_summaries([row['newsletter_id'] for row in rows])
+    items = [
+        {
+            'newsletter_id': row['newsletter_id'],
+            'date': _iso_date(row['timestamp']),
+            'subject': row['newslettersubject'],
+            'levels_summary': summaries.get(row['newsletter_id']),
+        }
+        for row in rows
+    ]
+    page = {
+        'items': items,
+        'next_cursor': items[-1]['newsletter_id'] if has_more and items else None,
+    }
+    _store_page(cache_key, page)
+    return page
+
+@anvil.server.callable
+def get_newsletter_text(newsletter_id, version='optimized'):
+    """
+    Returns the full text of one newsletter, fetched on demand.
+    version is 'optimized' (cleaned text) or 'original' (the email body as received).
+    """
+    from . import BodyStore
+
+    if version == 'original':
+        # Some legacy days have more than one newsletters row; the latest one wins
+        rows = app_tables.newsletters.search(
+            tables.order_by('timestamp', ascending=False),
+            newsletter_id=newsletter_id
+        )
+        row = next(iter(rows), None)
+        text = BodyStore.read_newsletter_body(row) if row is not None else None
+    elif version == 'optimized':
+        rows = app_tables.newsletteroptimized.search(
+            tables.order_by('timestamp', ascending=False),
+            newsletter_id=newsletter_id
+        )
+        row = next(iter(rows), None)
+        text = BodyStore.read_optimized_content(row) if row is not None else None
+    else:
+        raise ValueError(f"Unknown newsletter text version: {version}")
+
+    if row is None:
+        return None
+    return {
+        'newsletter_id': newsletter_id,
+        'version': version,
+        'text': text,
+    }
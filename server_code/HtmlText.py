@@ -0,0 +1,205 @@
+from html.parser import HTMLParser
+import re
+
+# This module converts HTML newsletter bodies to plain text.
+#
+# Primary responsibilities:
+# 1. Detects bodies that are HTML rather than plain text (find_body returns whichever
+#    part of the email carries data, which is the text/html part for HTML-only senders)
+# 2. Streams the HTML through a tag-level parser, dropping scripts, styles, hidden
+#    elements and tracking pixels
+# 3. Keeps the line structure: block elements, <br> and table rows become line breaks,
+#    and headings get their own line, so "Core Structures" and "Trade Plan" headers
+#    still start a line for semantic_section_chunker
+#
+# The converter is fed the HTML in CHUNK_SIZE pieces (or any iterable of string chunks)
+# and holds only the current tag, the names of the open elements and the line being
+# built. Memory therefore grows with
+# the input and the extracted text, not with the markup: for a multi-megabyte email
+# the extra working set beyond those two strings stays small. html_to_text still
+# collects the whole output, since callers need it as one string.
+#
+# Hidden elements are often left unclosed in email HTML. A hidden region ends at its
+# own end tag, or, as in a browser, at the end tag of any element that was already
+# open when it started (e.g. the </td> around an unclosed preheader <div>).
+# It has no Anvil imports and can run anywhere.
+
+CHUNK_SIZE = 64 * 1024
+
+# Elements whose content is never text
+SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template', 'svg', 'object', 'iframe'}
+
+# Elements that start and end a line
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'center', 'dd', 'div', 'dl', 'dt',
+    'fieldset', 'figcaption', 'figure', 'footer', 'form', 'header', 'hr', 'li', 'main',
+    'nav', 'ol', 'p', 'pre', 'section', 'table', 'tbody', 'thead', 'tfoot', 'tr', 'ul',
+}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+CELL_TAGS = {'td', 'th'}
+
+# Void elements have no end tag, so they never open a hidden or skipped region
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'param', 'source', 'track', 'wbr',
+}
+
+_HIDDEN_STYLE_PATTERN = re.compile(
+    r"display\s*:\s*none|visibility\s*:\s*hidden"
+    r"|(?:max-height|font-size)\s*:\s*0(?:\.0+)?(?:px|em|rem|pt|%)?\s*(?:;|!|$)"
+    r"|opacity\s*:\s*0(?:\.0+)?\s*(?:;|!|$)",
+    re.IGNORECASE
+)
+_HTML_PATTERN = re.compile(r"<\s*(?:!doctype\s+html|html|head|body|div|table|p|br|span|td)\b", re.IGNORECASE)
+_WHITESPACE_PATTERN = re.compile(r"[ \t\r\n\f\v\xa0]+")
+
+def looks_like_html(text, sample_size=4096):
+    """Returns True when text appears to be an HTML document or fragment."""
+    return bool(text) and bool(_HTML_PATTERN.search(text[:sample_size]))
+
+def body_text(body):
+    """Returns body as plain text: converted when it is HTML, unchanged otherwise."""
+    return html_to_text(body) if looks_like_html(body) else body
+
+def is_tracking_pixel(attrs):
+    """An <img> no bigger than 1x1, or hidden, is a tracking pixel rather than content."""
+    for dimension in ('width', 'height'):
+        value = (attrs.get(dimension) or '').strip().lower().rstrip('px')
+        if value in ('0', '1'):
+            return True
+    return bool(_HIDDEN_STYLE_PATTERN.search(attrs.get('style') or ''))
+
+class HtmlTextConverter(HTMLParser):
+    """
+    Incremental HTML-to-text converter. Call feed() with successive pieces of HTML,
+    then close(); finished lines are passed to write_line as they complete.
+    """
+
+    def __init__(self, write_line):
+        super().__init__(convert_charrefs=True)
+        self.write_line = write_line
+        self.line = []
+        self.skip_depth = 0
+        # Names of the open elements, and how many were open when the hidden region began
+        self.open_tags = []
+        self.hidden_depth = None
+        self.pre_depth = 0
+        self.blank_lines = 0
+
+    def _flush_line(self, force_blank=False):
+        text = "".join(self.line).strip() if not self.pre_depth else "".join(self.line).rstrip()
+        self.line = []
+        if text:
+            self.write_line(text)
+            self.blank_lines = 0
+        elif force_blank and self.blank_lines == 0:
+            # Paragraph breaks survive as a single blank line
+            self.write_line("")
+            self.blank_lines = 1
+
+    def _hidden(self):
+        return self.skip_depth or self.hidden_depth is not None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict((name, value or '') for name, value in attrs)
+        if tag == 'body':
+            # Recover from a <head> that was never closed
+            self.skip_depth = 0
+            return
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+            return
+        if tag in VOID_TAGS:
+            if self._hidden():
+                return
+            if tag == 'br':
+                self._flush_line()
+            elif tag == 'hr':
+                self._flush_line(force_blank=True)
+            elif tag == 'img' and not is_tracking_pixel(attrs) and attrs.get('alt', '').strip():
+                self.line.append(f" {attrs['alt'].strip()} ")
+            return
+        if self.hidden_depth is None and (_HIDDEN_STYLE_PATTERN.search(attrs.get('style', '')) or 'hidden' in attrs):
+            self.hidden_depth = len(self.open_tags)
+        self.open_tags.append(tag)
+        if self._hidden():
+            return
+        if tag in HEADING_TAGS:
+            self._flush_line(force_blank=True)
+        elif tag in BLOCK_TAGS:
+            self._flush_line(force_blank=tag in ('p', 'table', 'blockquote'))
+            if tag == 'li':
+                self.line.append("- ")
+            elif tag == 'pre':
+                self.pre_depth += 1
+        elif tag in CELL_TAGS and self.line:
+            self.line.append(" ")
+
+    def handle_startendtag(self, tag, attrs):
+        # <br/>, <img/> and friends
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if tag in self.open_tags:
+            # Unwind to the matching start tag, closing unclosed children with it
+            depth = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+            closed = self.open_tags[depth:] if self.hidden_depth is None else self.open_tags[depth:self.hidden_depth]
+            self.pre_depth = max(0, self.pre_depth - closed.count('pre'))
+            del self.open_tags[depth:]
+            if self.hidden_depth is not None and depth <= self.hidden_depth:
+                # The hidden element, or an element around it, was closed
+                closes_hidden = depth == self.hidden_depth
+                self.hidden_depth = None
+                if closes_hidden:
+                    return
+        if self._hidden():
+            return
+        if tag in HEADING_TAGS:
+            self._flush_line()
+            self._flush_line(force_blank=True)
+        elif tag in BLOCK_TAGS:
+            self._flush_line(force_blank=tag in ('p', 'table', 'blockquote'))
+
+    def handle_data(self, data):
+        if self._hidden():
+            return
+        if self.pre_depth:
+            lines = data.split('\n')
+            for line in lines[:-1]:
+                self.line.append(line)
+                self._flush_line(force_blank=True)
+            self.line.append(lines[-1])
+            return
+        self.line.append(_WHITESPACE_PATTERN.sub(' ', data))
+
+    def close(self):
+        super().close()
+        self._flush_line()
+
+def _chunks(source, chunk_size):
+    if isinstance(source, str):
+        for start in range(0, len(source), chunk_size):
+            yield source[start:start + chunk_size]
+    else:
+        yield from source
+
+def html_to_text(source, chunk_size=CHUNK_SIZE):
+    """
+    Converts HTML to plain text. source is an HTML string or an iterable of HTML
+    string chunks (e.g. decoded from a stream).
+    """
+    lines = []
+    converter = HtmlTextConverter(lines.append)
+    for chunk in _chunks(source, chunk_size):
+        converter.feed(chunk)
+    converter.close()
+    while lines and not lines[-1]:
+        lines.pop()
+    while lines and not lines[0]:
+        lines.pop(0)
+    return "\n".join(lines)
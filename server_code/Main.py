@@ -40,60 +40,332 @@ import datetime
 #   return 42
 #
 
+# Upper bound on concurrent Gmail fetches when several senders are registered
+MAX_FETCH_WORKERS = 4
+
 @anvil.server.callable
 @anvil.server.background_task
-def process_newsletter():
+def process_newsletter(profile=None):
     """
     Main orchestration function that coordinates the entire newsletter processing workflow.
     Ensures sequential processing and data consistency across all steps.
+    Every stage is checkpointed in the pipelinejobs table, so a failed run is
+    resumed from the failed stage the next time this task (or resume_newsletter_pipeline) runs.
+    
+    This scheduled task is the polling safety net; GmailPush.py ingests new
+    newsletters as soon as Gmail notifies us about them.
+    
+    profile turns on stage profiling for this run (see Profiling.py); by default the
+    pipeline_profiling secret decides.
+    """
+    return _process_all_senders(profile)
+
+def _fetch_for_sender(sender, service, credentials):
+    """
+    Worker-thread part of the fan-out: downloads the sender's latest email. Only talks
+    to Gmail; all table reads and writes happen on the calling thread.
+    """
+    from . import GetNewsletter
+    try:
+        return GetNewsletter.fetch_latest_message(service, sender, credentials)
+    except Exception as e:
+        print(f"Error fetching newsletter from {sender['name']}: {str(e)}")
+        return e
+
+def _process_all_senders(profile=None):
+    """
+    Runs the workflow for every registered sender. Gmail fetches fan out over a bounded
+    thread pool sharing one Gmail service; each newsletter's remaining stages then run in
+    their own background task, so extra senders don't lengthen the run linearly.
+    """
+    try:
+        from . import GetNewsletter, PipelineState, Profiling, Senders, utils
+        from concurrent.futures import ThreadPoolExecutor
+        
+        # Resolved once here; the resolved list is passed down to every sender's run
+        profile = Profiling.profiled_stages(profile)
+        senders = Senders.get_senders()
+        if len(senders) == 1:
+            return _process_newsletter(sender=senders[0], profile=profile)
+        
+        base_newsletter_id, _ = utils.get_newsletter_id()
+        credentials = GetNewsletter.get_gmail_credentials()
+        service = GetNewsletter.get_gmail_service(credentials)
+        
+        # Senders whose newsletter is already retrieved are resumed without a Gmail fetch
+        to_fetch = []
+        for sender in senders:
+            job = PipelineState.get_job(Senders.newsletter_id_for(base_newsletter_id, sender))
+            if job is None or not PipelineState.stage_done(job, 'retrieve'):
+                to_fetch.append(sender)
+        
+        messages = {}
+        if to_fetch:
+            print(f"Fetching newsletters from {len(to_fetch)} senders")
+            with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(to_fetch))) as pool:
+                fetched = pool.map(lambda sender: _fetch_for_sender(sender, service, credentials), to_fetch)
+                messages = {sender['name']: message for sender, message in zip(to_fetch, fetched)}
+        
+        results = {}
+        for sender in senders:
+            message = messages.get(sender['name'])
+            if isinstance(message, Exception):
+                results[sender['name']] = {'status': 'error', 'message': str(message)}
+                continue
+            # message is None when there was nothing new, or when the newsletter was already
+            # retrieved, in which case the run resumes it
+            results[sender['name']] = _process_newsletter(sender=sender, message=message, defer_stages=True, profile=profile)
+        
+        failed = [name for name, result in results.items() if result['status'] == 'error']
+        return {
+            'status': 'error' if failed else 'success',
+            'message': f"Processed {len(senders)} senders" + (f", failed: {', '.join(failed)}" if failed else ""),
+            'results': results
+        }
+    except Exception as e:
+        print(f"Error in multi-sender newsletter workflow: {str(e)}")
+        return {
+            'status': 'error',
+            'message': str(e)
+        }
+
+def _process_newsletter(message_id=None, sender=None, message=None, defer_stages=False, profile=None):
+    """
+    Runs the workflow for a sender's latest email (the primary sender by default), for a
+    specific Gmail message_id when called from the push ingestion worker, or for a message
+    already downloaded by _process_all_senders.
+    Holds the per-newsletter lease for the whole run, so overlapping invocations
+    (scheduled poll, push worker, manual retrieval) never process the same newsletter twice.
+    With defer_stages, the stages after retrieval run in a resume_newsletter_pipeline
+    background task launched once the lease is released.
+    profile is the stage profiling switch (see Profiling.profiled_stages).
     """
     print("Starting newsletter processing workflow")
     
     try:
-        from . import GetNewsletter, OptimizeNewsletter, MarketEvents, utils
+        from . import Profiling, RunLock, Senders, utils
+        
+        profile_stages = Profiling.profiled_stages(profile)
         
         # Step 1: Get newsletter_id for this session
-        newsletter_id, trading_day = utils.get_newsletter_id()
+        if sender is None:
+            sender = Senders.primary_sender()
+        base_newsletter_id, trading_day = utils.get_newsletter_id()
+        newsletter_id = Senders.newsletter_id_for(base_newsletter_id, sender)
         print(f"Processing newsletter for ID: {newsletter_id} (for {trading_day})")
         
-        # Step 2: Retrieve newsletter
-        print("Step 1: Initiating newsletter retrieval")
-        retrieval_result = GetNewsletter._get_latest_newsletter()
+        lease_name = RunLock.pipeline_lease_name(newsletter_id)
+        lease_owner = RunLock.acquire_lease(lease_name)
+        if lease_owner is None:
+            return {
+                'status': 'success',
+                'message': "Another run is already processing this newsletter",
+                'newsletter_id': newsletter_id
+            }
+        try:
+            result = _process_locked_newsletter(newsletter_id, lease_owner, message_id, sender, message, defer_stages, profile_stages)
+        finally:
+            RunLock.release_lease(lease_name, lease_owner)
         
-        if retrieval_result is None:
+        if result.pop('launch_stages', False):
+            # The stages may belong to a newsletter stored earlier under another ID
+            anvil.server.launch_background_task('resume_newsletter_pipeline', result['newsletter_id'], profile_stages)
+        return result
+            
+    except Exception as e:
+        print(f"Error in newsletter processing workflow: {str(e)}")
+        return {
+            'status': 'error',
+            'message': str(e)
+        }
+
+def _process_locked_newsletter(newsletter_id, lease_owner, message_id=None, sender=None, message=None, defer_stages=False, profile_stages=()):
+    """
+    Retrieves the newsletter if needed and runs the remaining stages. Caller holds the lease.
+    profile_stages is the resolved list of stages to profile.
+    """
+    from . import GetNewsletter, PipelineState, Profiling
+    
+    job = PipelineState.get_job(newsletter_id)
+    if job is not None and PipelineState.is_complete(job):
+        print(f"Newsletter {newsletter_id} has already been fully processed")
+        return {
+            'status': 'success',
+            'message': "Newsletter already processed",
+            'newsletter_id': newsletter_id
+        }
+    
+    # Step 2: Retrieve newsletter, unless an earlier run already stored it
+    if job is None or not PipelineState.stage_done(job, 'retrieve'):
+        print("Step 1: Initiating newsletter retrieval")
+        if message is None and defer_stages:
+            # The fan-out found nothing to download for this sender
             return {
                 'status': 'success',
                 'message': "No new newsletter to process"
             }
-        elif retrieval_result == "DUPLICATE":
+        if 'retrieve' in profile_stages:
+            retrieval_result = Profiling.run_profiled(
+                newsletter_id, 'retrieve', GetNewsletter._get_latest_newsletter,
+                message_id, sender, message, newsletter_id
+            )
+        else:
+            retrieval_result = GetNewsletter._get_latest_newsletter(message_id, sender, message, newsletter_id)
+        
+        if retrieval_result is None:
             return {
                 'status': 'success',
-                'message': "Duplicate newsletter detected"
+                'message': "No new newsletter to process"
             }
-            
-        # Step 3: Initialize analysis record
-        analysis_row = app_tables.newsletteranalysis.add_row(
-            newsletter_id=newsletter_id,
-            timestamp=datetime.datetime.now()
-        )
-            
-        # Step 4: Process market events
-        print("Step 2: Processing market events")
-        market_events = MarketEvents.process_market_events(newsletter_id)
-            
-        # Step 5: Optimize newsletter content
-        print("Step 3: Optimizing newsletter content")
-        optimization_result = OptimizeNewsletter.optimize_latest_newsletter(newsletter_id)
-            
-        print("Newsletter processing completed")
+        elif isinstance(retrieval_result, tuple) and retrieval_result[0] == GetNewsletter.DUPLICATE:
+            # The email was stored by an earlier run, possibly under another newsletter_id
+            # (the 23:00 and 00:00 runs compute different IDs). If that run failed after the
+            # insert, its pipeline is resumed here instead of being reported as a duplicate.
+            stored_newsletter_id = retrieval_result[1]
+            if stored_newsletter_id != newsletter_id:
+                return _resume_stored_newsletter(stored_newsletter_id, defer_stages, profile_stages)
+            print("Newsletter already stored by an earlier run, resuming its pipeline")
+            retrieval_result = {}
+        
+        PipelineState.checkpoint_retrieval(newsletter_id, retrieval_result)
+    else:
+        print("Step 1: Newsletter already retrieved, skipping Gmail fetch")
+    
+    if defer_stages:
+        return {
+            'status': 'success',
+            'message': "Newsletter retrieved, pipeline task launched",
+            'newsletter_id': newsletter_id,
+            'launch_stages': True
+        }
+    return run_pipeline_stages(newsletter_id, lease_owner, profile_stages)
+
+def _resume_stored_newsletter(newsletter_id, defer_stages=False, profile_stages=()):
+    """
+    Resumes the pipeline of a newsletter stored by an earlier run under newsletter_id,
+    unless it is complete. Takes that newsletter's own lease.
+    """
+    from . import PipelineState, RunLock
+    
+    job = PipelineState.get_job(newsletter_id)
+    # Newsletters stored before idempotency keys existed predate the pipelinejobs table
+    # too; they have no job because they were processed by the old workflow
+    legacy = job is None and not any(
+        row['idempotency_key'] for row in app_tables.newsletters.search(newsletter_id=newsletter_id)
+    )
+    if legacy or (job is not None and PipelineState.is_complete(job)):
         return {
             'status': 'success',
-            'message': "Newsletter processing complete",
+            'message': "Duplicate newsletter detected",
             'newsletter_id': newsletter_id
         }
-            
+    
+    lease_name = RunLock.pipeline_lease_name(newsletter_id)
+    lease_owner = RunLock.acquire_lease(lease_name)
+    if lease_owner is None:
+        return {
+            'status': 'success',
+            'message': "Another run is already processing this newsletter",
+            'newsletter_id': newsletter_id
+        }
+    try:
+        print(f"Newsletter already stored as {newsletter_id} by an earlier run, resuming its pipeline")
+        job = PipelineState.get_job(newsletter_id)
+        if job is None or not PipelineState.stage_done(job, 'retrieve'):
+            PipelineState.checkpoint_retrieval(newsletter_id, {})
+        if defer_stages:
+            return {
+                'status': 'success',
+                'message': "Stored newsletter found, pipeline task launched",
+                'newsletter_id': newsletter_id,
+                'launch_stages': True
+            }
+        return run_pipeline_stages(newsletter_id, lease_owner, profile_stages)
+    finally:
+        RunLock.release_lease(lease_name, lease_owner)
+
+def _create_analysis_row(newsletter_id):
+    """Initializes the analysis record. The idempotency key means a retry never adds a second one."""
+    from . import RunLock
+    RunLock.add_row_once(
+        app_tables.newsletteranalysis,
+        RunLock.newsletter_idempotency_key('analysis', newsletter_id),
+        newsletter_id=newsletter_id,
+        timestamp=datetime.datetime.now()
+    )
+    return None
+
+def run_pipeline_stages(newsletter_id, lease_owner, profile_stages=()):
+    """
+    Runs every post-retrieval stage that has not completed yet for newsletter_id.
+    Stops at the first failing stage and records it, so the next call resumes there.
+    The caller must hold the newsletter's pipeline lease; it is extended before each stage.
+    Stages in profile_stages (see Profiling.profiled_stages) run under Profiling.run_profiled.
+    """
+    from . import OptimizeNewsletter, MarketEvents, PipelineState, Profiling, RunLock
+    
+    job = PipelineState.get_job(newsletter_id)
+    if job is None or not PipelineState.stage_done(job, 'retrieve'):
+        raise ValueError(f"Newsletter {newsletter_id} has not been retrieved yet")
+    
+    stage_functions = {
+        'analysis_row': _create_analysis_row,
+        'market_events': MarketEvents.process_market_events,
+        'optimize': OptimizeNewsletter.optimize_latest_newsletter,
+    }
+    lease_name = RunLock.pipeline_lease_name(newsletter_id)
+    
+    PipelineState.begin_attempt(job)
+    for step, stage in enumerate(PipelineState.pending_stages(job), start=2):
+        RunLock.heartbeat(lease_name, lease_owner)
+        print(f"Step {step}: Running stage '{stage}'")
+        PipelineState.start_stage(job, stage)
+        try:
+            if stage in profile_stages:
+                output = Profiling.run_profiled(newsletter_id, stage, stage_functions[stage], newsletter_id)
+            else:
+                output = stage_functions[stage](newsletter_id)
+        except Exception as e:
+            PipelineState.fail_stage(job, stage, e)
+            return {
+                'status': 'error',
+                'message': str(e),
+                'newsletter_id': newsletter_id,
+                'failed_stage': stage
+            }
+        PipelineState.complete_stage(job, stage, output)
+    
+    print("Newsletter processing completed")
+    return {
+        'status': 'success',
+        'message': "Newsletter processing complete",
+        'newsletter_id': newsletter_id
+    }
+
+@anvil.server.callable
+@anvil.server.background_task
+def resume_newsletter_pipeline(newsletter_id, profile=None):
+    """
+    Resumes the pipeline for newsletter_id from its first unfinished stage.
+    profile is the stage profiling switch (see Profiling.profiled_stages).
+    """
+    from . import Profiling, RunLock
+    print(f"Resuming newsletter pipeline for ID: {newsletter_id}")
+    try:
+        lease_name = RunLock.pipeline_lease_name(newsletter_id)
+        lease_owner = RunLock.acquire_lease(lease_name)
+        if lease_owner is None:
+            return {
+                'status': 'success',
+                'message': "Another run is already processing this newsletter",
+                'newsletter_id': newsletter_id
+            }
+        try:
+            return run_pipeline_stages(newsletter_id, lease_owner, Profiling.profiled_stages(profile))
+        finally:
+            RunLock.release_lease(lease_name, lease_owner)
     except Exception as e:
-        print(f"Error in newsletter processing workflow: {str(e)}")
+        print(f"Error resuming newsletter pipeline: {str(e)}")
         return {
             'status': 'error',
             'message': str(e)
@@ -101,7 +373,9 @@ def process_newsletter():
 
 # Temporary test function for optimize_latest_newsletter
 @anvil.server.callable
-def test_optimize_newsletter():
-    """Temporary test function to launch the optimize_latest_newsletter background task from the OptimizeNewsletter module."""
-    from . import OptimizeNewsletter
-    return anvil.server.launch_background_task('optimize_latest_newsletter')
+def test_optimize_newsletter(newsletter_id=None, profile=None):
+    """Temporary test function that resumes the pipeline (including optimization) for a newsletter in a background task."""
+    from . import utils
+    if newsletter_id is None:
+        newsletter_id, _ = utils.get_newsletter_id()
+    return anvil.server.launch_background_task('resume_newsletter_pipeline', newsletter_id, profile)
@@ -5,7 +5,6 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
-import spacy
 import re
 import datetime  # <--- Added datetime import for timestamp handling
 import time
@@ -27,29 +26,32 @@ import time
 #   return 42
 #
 
-# Initialize spaCy model for newsletter analysis
-try:
-    nlp = spacy.load("en_core_web_sm")
-except OSError:
-    import spacy.cli
-    spacy.cli.download("en_core_web_sm")
-    nlp = spacy.load("en_core_web_sm")
-from spacy.tokens import Doc
-if not Doc.has_extension("support_resistance"):
-    Doc.set_extension("support_resistance", default=[])
+from . import HtmlText
+from . import TextPipeline
 
-# Register the custom pipeline component with a name using the decorator
-@spacy.Language.component("support_resistance_detector")
-def support_resistance_detector(doc):
-    """Custom spaCy pipeline component to detect support/resistance levels."""
-    pattern = r"(\d+\.\d+)\s*(?:support|resistance)"
-    matches = re.findall(pattern, doc.text, flags=re.IGNORECASE)
-    doc._.support_resistance = matches
-    return doc
+# The spaCy pipeline itself lives in TextPipeline.py, which is loaded lazily and can also
+# run in the warm Uplink worker (local_tools/nlp_worker.py). Heavy NLP calls go through
+# _run_nlp, which uses the worker when it is connected and runs in-process otherwise.
 
-# Add the custom component by its name instead of passing the function
-if "support_resistance_detector" not in nlp.pipe_names:
-    nlp.add_pipe("support_resistance_detector", last=True)
+# Prefix of the functions the Uplink NLP worker registers
+NLP_WORKER_PREFIX = "nlp_worker_"
+
+# Errors meaning the worker could not be reached, rather than that the pipeline failed
+_NLP_WORKER_UNAVAILABLE = (anvil.server.UplinkDisconnectedError, anvil.server.TimeoutError)
+
+def _run_nlp(name, *args):
+    """
+    Runs TextPipeline.<name>(*args) on the Uplink NLP worker if one is connected,
+    falling back to running it in this server process when no worker is connected or
+    the connection to it fails. Errors raised by the pipeline itself propagate.
+    """
+    try:
+        return anvil.server.call(NLP_WORKER_PREFIX + name, *args)
+    except anvil.server.NoServerFunctionError:
+        pass  # No worker connected
+    except _NLP_WORKER_UNAVAILABLE as e:
+        print(f"NLP worker unavailable for {name}, running in-process instead: {str(e)}")
+    return getattr(TextPipeline, name)(*args)
 
 def clean_text(text):
     """Cleans the text by removing URLs, timestamps, and specific unwanted sections."""
@@ -66,6 +68,29 @@ def clean_text(text):
     text = text.strip()  # Remove leading/trailing whitespace
     return text
 
+def clean_basic_text(text):
+    """Sender-neutral cleaning: line endings, URLs and blank lines only."""
+    text = text.replace('\r\n', '\n')
+    text = re.sub(r'https?://\S+', '', text)   # Remove URLs
+    text = re.sub(r'^\s*\n', '', text)  # Remove leading empty lines
+    text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)  # Replace multiple empty lines with a single empty line
+    return text.strip()
+
+# Cleaning profiles a sender can select in the Senders registry
+CLEANING_PROFILES = {
+    'default': clean_text,
+    'basic': clean_basic_text,
+}
+
+def clean_newsletter_text(text, profile='default'):
+    """
+    Cleans text with the named cleaning profile. HTML bodies are converted to
+    plain text first (see HtmlText.py), so every profile only sees text.
+    """
+    if profile not in CLEANING_PROFILES:
+        raise ValueError(f"Unknown cleaning profile: {profile}")
+    return CLEANING_PROFILES[profile](HtmlText.body_text(text))
+
 def segment_text(text):
     """Discards and preserves sections for analysis.
     Discards content from 'The Run Down on The Level To Level Approach: What, Why, How' up to 'Core Structures/Levels To Engage',
@@ -112,8 +137,7 @@ def format_keylevels_raw(text):
 
 def extract_key_levels(text):
     """Extracts key support/resistance levels using the custom spaCy pipeline."""
-    doc = nlp(text)
-    return doc._.support_resistance
+    return _run_nlp("extract_key_levels", text)
 
 def identify_trade_setups(text):
     """Identifies potential trade setups from the text."""
@@ -125,173 +149,19 @@ def calculate_risk_factors(text):
     risk_count = len(re.findall(r'\brisk\b', text, flags=re.IGNORECASE))
     return {"risk_score": risk_count}
 
-@spacy.Language.component("market_sentiment_analyzer")
-def market_sentiment_analyzer(doc):
-    """Analyzes market sentiment in the text."""
-    bullish_terms = ['bullish', 'upward', 'higher', 'rally', 'squeeze', 'long']
-    bearish_terms = ['bearish', 'downward', 'lower', 'breakdown', 'short', 'sell']
-    
-    bull_count = 0
-    bear_count = 0
-    
-    for token in doc:
-        if token.text.lower() in bullish_terms:
-            bull_count += 1
-        elif token.text.lower() in bearish_terms:
-            bear_count += 1
-    
-    total = bull_count + bear_count
-    if total > 0:
-        sentiment_score = (bull_count - bear_count) / total  # -1 to 1 scale
-    else:
-        sentiment_score = 0
-        
-    doc._.market_sentiment = {
-        'score': sentiment_score,
-        'bullish_mentions': bull_count,
-        'bearish_mentions': bear_count
-    }
-    return doc
-
-# Register the extension
-if not Doc.has_extension("market_sentiment"):
-    Doc.set_extension("market_sentiment", default={})
-
-@spacy.Language.component("price_level_detector")
-def price_level_detector(doc):
-    """Detects price levels and their context (support/resistance/target)."""
-    price_pattern = r'(\d{4}(?:\.\d{1,2})?)'  # Matches 4-digit prices with optional decimals
-    level_info = []
-    
-    for match in re.finditer(price_pattern, doc.text):
-        price = match.group(1)
-        # Get surrounding context (20 chars before and after)
-        start = max(0, match.start() - 20)
-        end = min(len(doc.text), match.end() + 20)
-        context = doc.text[start:end]
-        
-        level_type = 'unknown'
-        if 'support' in context.lower():
-            level_type = 'support'
-        elif 'resistance' in context.lower():
-            level_type = 'resistance'
-        elif 'target' in context.lower():
-            level_type = 'target'
-            
-        level_info.append({
-            'price': price,
-            'type': level_type,
-            'context': context.strip()
-        })
-    
-    doc._.price_levels = level_info
-    return doc
-
-# Register the extension for price levels
-if not Doc.has_extension("price_levels"):
-    Doc.set_extension("price_levels", default=[])
-
-# Add components to pipeline in correct order
-if "price_level_detector" not in nlp.pipe_names:
-    nlp.add_pipe("price_level_detector", after="support_resistance_detector")
-
-if "market_sentiment_analyzer" not in nlp.pipe_names:
-    nlp.add_pipe("market_sentiment_analyzer", after="price_level_detector")
-
-@spacy.Language.component("semantic_section_chunker")
-def semantic_section_chunker(doc):
-    """Identifies and chunks newsletter sections based on semantic headers and content."""
-    # Define common newsletter section headers with more variations
-    section_headers = {
-        'core_levels': ['core structures', 'key levels', 'levels to engage', 'Core Structures', 'CORE STRUCTURES',
-                       'Key Levels', 'KEY LEVELS', 'Levels to Engage', 'LEVELS TO ENGAGE'],
-        'trade_recap': ['trade recap', 'trading recap', 'trade education', 'Trade Recap', 'TRADE RECAP',
-                       'Trading Recap', 'TRADING RECAP', 'Trade Education', 'TRADE EDUCATION']
-    }
-    
-    # Store identified sections
-    doc._.sections = {}
-    
-    # Initialize trade_plan_start outside the conditional block
-    trade_plan_start = -1
-    
-    # First find the trade plan section as it will be used as a boundary
-    if doc._.trading_day:  # Only proceed if we have the trading day information
-        print(f"\nLooking for trade plan section for {doc._.trading_day}")
-        plan_day_pattern = fr"Trade Plan\s*[:\-]?\s*{doc._.trading_day}"
-        plan_day_matches = list(re.finditer(plan_day_pattern, doc.text, re.IGNORECASE))
-        if plan_day_matches:
-            print(f"\nFound {len(plan_day_matches)} instances of 'Trade Plan {doc._.trading_day}':")
-            match = plan_day_matches[0]
-            section_start = match.start()
-            # Look for the next header from a list of known section headers
-            next_header_pattern = r"\n\s*(?:Trade Recap|Trading Recap|Trade Education|Core Structures|Levels to Engage)\b"
-            next_header_match = re.search(next_header_pattern, doc.text[section_start:], re.IGNORECASE)
-            if next_header_match:
-                section_end = section_start + next_header_match.start()
-            else:
-                section_end = len(doc.text)
-            doc._.sections['trade_plan'] = doc.text[section_start:section_end].strip()
-            print(f"Extracted trade_plan section, length: {len(doc._.sections['trade_plan'])} chars")
-        else:
-            print(f"No instances of 'Trade Plan {doc._.trading_day}' found!")
-    
-    # Find section boundaries for other sections
-    section_spans = []
-    for section_type, headers in section_headers.items():
-        for header in headers:
-            # Use re.finditer for case-insensitive matching
-            matches = re.finditer(re.escape(header), doc.text, re.IGNORECASE)
-            for match in matches:
-                section_spans.append((match.start(), section_type))
-                print(f"Found {section_type} section with header: {header}")
-    
-    # Sort section spans by their start position
-    section_spans.sort(key=lambda x: x[0])
-    
-    # Extract sections
-    for i in range(len(section_spans)):
-        start_pos = section_spans[i][0]
-        section_type = section_spans[i][1]
-        
-        # End position is either the start of next section, trade plan start, or end of document
-        if i < len(section_spans) - 1:
-            end_pos = section_spans[i + 1][0]
-        else:
-            end_pos = len(doc.text)
-        
-        # If this is the trade_recap section and we found a trade plan, use trade plan start as boundary
-        if section_type == 'trade_recap' and trade_plan_start != -1:
-            end_pos = min(end_pos, trade_plan_start)
-        
-        # Find the actual start of content (skip header line)
-        section_text = doc.text[start_pos:end_pos]
-        content_start = section_text.find('\n')
-        if content_start != -1:
-            start_pos += content_start + 1
-        
-        # Store the section content
-        section_content = doc.text[start_pos:end_pos].strip()
-        doc._.sections[section_type] = section_content
-        print(f"Stored {section_type} section with length: {len(section_content)} chars")
-    
-    # Debug print final sections
-    print("Final sections found:", list(doc._.sections.keys()))
-    
-    return doc
-
-# Register the section extension
-if not Doc.has_extension("sections"):
-    Doc.set_extension("sections", default={})
-
-# Add semantic chunker to pipeline
-if "semantic_section_chunker" not in nlp.pipe_names:
-    nlp.add_pipe("semantic_section_chunker", after="market_sentiment_analyzer")
-
 def get_newsletter_sections(text):
     """Process newsletter text and return semantically chunked sections."""
-    doc = nlp(text)
-    return doc._.sections
+    return _run_nlp("get_newsletter_sections", text)
+
+def chunk_sections(text, trading_day, section_rules=None):
+    """Chunks text into sections for the trading day (see TextPipeline.chunk_sections)."""
+    return _run_nlp("chunk_sections", text, trading_day, section_rules)
+
+def extract_sections_features(texts):
+    """Runs the extraction components over each section text (see TextPipeline.extract_section_features)."""
+    if not texts:
+        return []
+    return _run_nlp("extract_sections_features", list(texts))
 
 def get_newsletter_id(session_date=None):
     """
@@ -343,24 +213,37 @@ def optimize_latest_newsletter(newsletter_id):
         raise ValueError(f"No newsletter found for ID {newsletter_id}")
     
     # Get the trading day name for this newsletter - use newsletter_id instead of timestamp
-    from . import utils
+    from . import utils, Senders
     # Convert newsletter_id to datetime for the trading day
-    newsletter_date = datetime.datetime.strptime(newsletter_id, "%Y%m%d")
+    newsletter_date = utils.newsletter_date(newsletter_id)
     _, trading_day = utils.get_newsletter_id(newsletter_date)
     print(f"Processing newsletter for trading day: {trading_day}")
     
+    # Each sender has its own cleaning profile and section rules
+    sender_key = utils.sender_key_of(newsletter_id)
+    sender = Senders.get_sender(sender_key)
+    
     # Clean and process the content
-    cleaned_body = clean_text(newsletter['newsletterbody'])
+    from . import BodyStore, Boilerplate
+    cleaned_body = clean_newsletter_text(BodyStore.read_newsletter_body(newsletter), sender['cleaning_profile'])
+    
+    # Strip paragraphs the boilerplate model has learned recur in most issues of
+    # this sender, then count this newsletter into the model
+    boilerplate_model = sender_key or Boilerplate.MODEL_NAME
+    full_cleaned_body = cleaned_body
+    cleaned_body, boilerplate_stats = Boilerplate.strip_boilerplate(full_cleaned_body, model_name=boilerplate_model)
+    Boilerplate.index_newsletter(newsletter, full_cleaned_body, model_name=boilerplate_model)
+    
+    # Chunk the document into sections for this trading day
+    sections = chunk_sections(cleaned_body, trading_day, sender['section_rules'])
     
-    # Create a custom spaCy doc with the trading day information
-    doc = nlp(cleaned_body)
-    doc._.trading_day = trading_day  # Store trading day for use in semantic_section_chunker
-    sections = doc._.sections  # Get sections directly from the processed doc
+    # Extract only the sections that changed since the previous newsletter
+    from . import SectionDiff
+    section_diff = SectionDiff.diff_against_previous(newsletter_id, cleaned_body, sender['section_rules'])
     
-    # Extract and format levels
-    core_levels = sections.get('core_levels', '')
-    formatted_levels = format_preserved_levels(core_levels)
-    raw_levels = format_keylevels_raw(formatted_levels)
+    # Key levels come from the section diff, the same level set levels_added/removed cover
+    formatted_levels = section_diff['formatted_levels']
+    raw_levels = "\n".join(section_diff['levels'])
     trade_plan_text = sections.get('trade_plan', '')
     
     if trade_plan_text:
@@ -376,20 +259,35 @@ def optimize_latest_newsletter(newsletter_id):
             tradeplan=trade_plan_text
         )
     
-    # Create optimized content record
-    app_tables.newsletteroptimized.add_row(
+    # Create optimized content record (or refresh it when the optimization is re-run)
+    from . import RunLock
+    optimized_values = dict(
         newsletter_id=newsletter_id,
         keylevels=formatted_levels,
         keylevelsraw=raw_levels,
         tradeplan=trade_plan_text,
-        optimized_content=cleaned_body,
         core_levels=sections.get('core_levels', ''),
         trade_recap=sections.get('trade_recap', ''),
-        timestamp=datetime.datetime.now()
+        levels_added="\n".join(section_diff['levels_added']),
+        levels_removed="\n".join(section_diff['levels_removed']),
+        boilerplate_bytes_removed=boilerplate_stats['bytes_removed'],
+        boilerplate_tokens_removed=boilerplate_stats['tokens_removed'],
+        timestamp=datetime.datetime.now(),
+        # Re-optimizing an archived newsletter makes its row live again
+        archived=False,
+        **BodyStore.compressed_columns('optimized_content', cleaned_body)
     )
+    optimized_row, created = RunLock.add_row_once(
+        app_tables.newsletteroptimized,
+        RunLock.newsletter_idempotency_key('optimized', newsletter_id),
+        **optimized_values
+    )
+    if not created:
+        optimized_row.update(**optimized_values)
+    
+    from . import HistoryAPI, SearchIndex
+    HistoryAPI.invalidate_history_cache()
+    SearchIndex.index_newsletter(newsletter_id, cleaned_body, 'optimized')
     
     return "Newsletter optimization completed successfully"
 
-# Register the trading day extension for spaCy Doc
-if not Doc.has_extension("trading_day"):
-    Doc.set_extension("trading_day", default=None)
@@ -0,0 +1,139 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import datetime
+
+# This module persists the state of the newsletter processing pipeline.
+#
+# Primary responsibilities:
+# 1. Keeps one row per newsletter_id in the pipelinejobs table
+# 2. Records the status, timing, error and output of every pipeline stage
+# 3. Lets Main.py resume a failed run from the stage that failed, without
+#    re-fetching the newsletter from Gmail or re-running finished stages
+#
+# Stage state is stored as a simpleObject keyed by stage name, e.g.
+#   {'retrieve': {'status': 'done', 'started': '...', 'finished': '...',
+#                 'error': None, 'output': {...}}}
+# Timestamps inside the stage state are ISO strings so the value stays JSON-safe.
+
+# Ordered list of pipeline stages. Main.py runs them in this order.
+STAGES = ['retrieve', 'analysis_row', 'market_events', 'optimize']
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+def _now():
+    return datetime.datetime.now()
+
+def get_job(newsletter_id):
+    """Returns the pipelinejobs row for a newsletter_id, or None if no run has started."""
+    return app_tables.pipelinejobs.get(newsletter_id=newsletter_id)
+
+@tables.in_transaction
+def get_or_create_job(newsletter_id):
+    """Returns the pipelinejobs row for a newsletter_id, creating it if necessary."""
+    job = app_tables.pipelinejobs.get(newsletter_id=newsletter_id)
+    if job is None:
+        now = _now()
+        job = app_tables.pipelinejobs.add_row(
+            newsletter_id=newsletter_id,
+            status=STATUS_PENDING,
+            current_stage=STAGES[0],
+            stages={stage: {'status': STATUS_PENDING} for stage in STAGES},
+            attempts=0,
+            last_error=None,
+            created=now,
+            updated=now
+        )
+    return job
+
+def stage_state(job, stage):
+    """Returns the stored state dict for a stage."""
+    return (job['stages'] or {}).get(stage) or {'status': STATUS_PENDING}
+
+def stage_done(job, stage):
+    return stage_state(job, stage).get('status') == STATUS_DONE
+
+def stage_output(job, stage):
+    """Returns the output recorded when a stage completed, or None."""
+    return stage_state(job, stage).get('output')
+
+def pending_stages(job):
+    """Returns the stages that still need to run, in pipeline order."""
+    return [stage for stage in STAGES if not stage_done(job, stage)]
+
+def is_complete(job):
+    return not pending_stages(job)
+
+def _update_stage(job, stage, **changes):
+    stages = dict(job['stages'] or {})
+    state = dict(stages.get(stage) or {'status': STATUS_PENDING})
+    state.update(changes)
+    stages[stage] = state
+    return stages
+
+def start_stage(job, stage):
+    """Marks a stage as running."""
+    stages = _update_stage(job, stage, status=STATUS_RUNNING, started=_now().isoformat(), error=None)
+    job.update(
+        stages=stages,
+        status=STATUS_RUNNING,
+        current_stage=stage,
+        updated=_now()
+    )
+    print(f"Pipeline {job['newsletter_id']}: stage '{stage}' started")
+
+def complete_stage(job, stage, output=None):
+    """Checkpoints a finished stage together with its output."""
+    stages = _update_stage(job, stage, status=STATUS_DONE, finished=_now().isoformat(), error=None, output=output)
+    job.update(stages=stages, updated=_now())
+    remaining = pending_stages(job)
+    if remaining:
+        job.update(current_stage=remaining[0])
+    else:
+        job.update(status=STATUS_DONE, current_stage=None, last_error=None)
+    print(f"Pipeline {job['newsletter_id']}: stage '{stage}' done")
+
+def fail_stage(job, stage, error):
+    """Records a failed stage. The job stays resumable from this stage."""
+    message = str(error)
+    stages = _update_stage(job, stage, status=STATUS_FAILED, finished=_now().isoformat(), error=message)
+    job.update(
+        stages=stages,
+        status=STATUS_FAILED,
+        current_stage=stage,
+        last_error=message,
+        updated=_now()
+    )
+    print(f"Pipeline {job['newsletter_id']}: stage '{stage}' failed: {message}")
+
+def checkpoint_retrieval(newsletter_id, retrieval_result):
+    """Creates the job if needed and checkpoints the retrieve stage from a _get_latest_newsletter result."""
+    job = get_or_create_job(newsletter_id)
+    complete_stage(job, 'retrieve', {
+        'subject': retrieval_result.get('subject'),
+        'date': retrieval_result.get('date')
+    })
+    return job
+
+def begin_attempt(job):
+    """Counts a new run (initial or retry) against the job."""
+    job.update(attempts=(job['attempts'] or 0) + 1, updated=_now())
+
+@anvil.server.callable
+def get_pipeline_status(newsletter_id):
+    """Returns a plain dict describing the pipeline state for a newsletter_id."""
+    job = get_job(newsletter_id)
+    if job is None:
+        return None
+    return {
+        'newsletter_id': job['newsletter_id'],
+        'status': job['status'],
+        'current_stage': job['current_stage'],
+        'attempts': job['attempts'],
+        'last_error': job['last_error'],
+        'stages': {stage: {k: v for k, v in stage_state(job, stage).items() if k != 'output'} for stage in STAGES}
+    }
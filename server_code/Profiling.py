@@ -0,0 +1,212 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import cProfile
+import datetime
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+# This module profiles pipeline stages on demand.
+#
+# Primary responsibilities:
+# 1. Decides which stages of a run are profiled, from a per-call switch or the
+#    pipeline_profiling secret
+# 2. Runs a profiled stage under cProfile and tracemalloc
+# 3. Stores the slowest functions and the allocation sites at the stage's memory peak
+#    in the pipelineprofiles table, one row per (newsletter_id, stage, run)
+#
+# The switch is resolved once, where a run enters Main (one secret read when no
+# per-call switch is given), into a list of stage names that is passed down to the
+# stages and to any background task the run launches. An unprofiled stage is called
+# directly; nothing else is done for it.
+#
+# Peak allocation sites come from a sampler thread that snapshots tracemalloc whenever
+# traced memory has grown PEAK_GROWTH past the last snapshot. The snapshot taken
+# closest to the peak is reported, so allocations freed before the stage returns (such
+# as spaCy Doc construction) are included. A spike shorter than PEAK_SAMPLE_SECONDS
+# can be missed; peak_memory_bytes is exact either way.
+#
+# Switch values (per call via the profile argument, or the pipeline_profiling secret):
+# - True / 'all': profile every stage
+# - a list of stage names, or a comma-separated string of them: profile those stages
+# - False / empty / missing secret: profiling off
+#
+# Stages that run in the Uplink NLP worker are only profiled up to the worker call.
+
+PROFILING_SECRET = 'pipeline_profiling'
+
+# Number of functions / allocation sites stored per profile
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 25
+
+# Frames kept per traced allocation
+TRACE_FRAMES = 1
+
+# How often the peak sampler checks traced memory, and how much it must have grown
+# past the last snapshot for a new one
+PEAK_SAMPLE_SECONDS = 0.05
+PEAK_GROWTH = 1.1
+
+def profiled_stages(profile=None):
+    """
+    Resolves a profiling switch into the sorted list of stage names to profile.
+    With profile=None, the pipeline_profiling secret decides. An already resolved
+    list resolves to itself without reading the secret.
+    """
+    from . import PipelineState, utils
+
+    if profile is None:
+        profile = utils.get_optional_secret(PROFILING_SECRET, False)
+    if profile is True or (isinstance(profile, str) and profile.strip().lower() in ('all', 'true', '1', 'yes')):
+        return list(PipelineState.STAGES)
+    if not profile or (isinstance(profile, str) and profile.strip().lower() in ('false', '0', 'no', 'off')):
+        return []
+    if isinstance(profile, str):
+        profile = profile.split(',')
+    return sorted({stage.strip() for stage in profile if stage.strip()})
+
+def _top_functions(profiler):
+    stats = pstats.Stats(profiler).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {
+            'function': f"{os.path.basename(filename)}:{line}({name})",
+            'calls': calls,
+            'own_seconds': round(own_time, 6),
+            'cumulative_seconds': round(cumulative_time, 6),
+        }
+        for (filename, line, name), (_, calls, own_time, cumulative_time, _) in ranked
+    ]
+
+# Allocations made by the profiler itself are left out of the report
+_OWN_TRACES = [
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, threading.__file__),
+]
+
+class _PeakSampler(threading.Thread):
+    """Snapshots tracemalloc each time traced memory reaches a new high (see PEAK_GROWTH)."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopped = threading.Event()
+        self.snapshot = None
+        self.snapshot_memory = 0
+
+    def sample(self):
+        current = tracemalloc.get_traced_memory()[0]
+        if self.snapshot is None or current > self.snapshot_memory * PEAK_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_memory = current
+
+    def run(self):
+        while not self.stopped.wait(PEAK_SAMPLE_SECONDS):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        # The stage may end at its peak
+        self.sample()
+        return self.snapshot
+
+def _top_allocations(start_snapshot, peak_snapshot):
+    """The allocation sites that grew the most between the start of the stage and its peak."""
+    differences = peak_snapshot.filter_traces(_OWN_TRACES).compare_to(start_snapshot.filter_traces(_OWN_TRACES), 'lineno')
+    differences.sort(key=lambda stat: stat.size_diff, reverse=True)
+    return [
+        {
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size_bytes': stat.size_diff,
+            'count': stat.count_diff,
+        }
+        for stat in differences[:TOP_ALLOCATIONS]
+        if stat.size_diff > 0
+    ]
+
+def run_profiled(newsletter_id, stage, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) under cProfile and tracemalloc and stores the profile
+    for newsletter_id and stage. Returns func's result; if func raises, the profile is
+    still stored and the exception propagates.
+    """
+    # Keep tracing if something else (e.g. an outer profiled call) already started it
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACE_FRAMES)
+    tracemalloc.reset_peak()
+    start_snapshot = tracemalloc.take_snapshot()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    sampler = _PeakSampler()
+    sampler.start()
+
+    profiler = cProfile.Profile()
+    error = None
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        profiler.disable()
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+        peak_snapshot = sampler.stop()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+        _store_profile(
+            newsletter_id, stage, wall_seconds, cpu_seconds,
+            max(0, peak_memory - start_memory),
+            _top_functions(profiler),
+            _top_allocations(start_snapshot, peak_snapshot),
+            error
+        )
+
+def _store_profile(newsletter_id, stage, wall_seconds, cpu_seconds, peak_memory, top_functions, top_allocations, error):
+    try:
+        app_tables.pipelineprofiles.add_row(
+            newsletter_id=newsletter_id,
+            stage=stage,
+            wall_seconds=round(wall_seconds, 4),
+            cpu_seconds=round(cpu_seconds, 4),
+            peak_memory_bytes=peak_memory,
+            top_functions=top_functions,
+            top_allocations=top_allocations,
+            error=error,
+            created=datetime.datetime.now()
+        )
+        print(f"Profiled stage '{stage}' for {newsletter_id}: {wall_seconds:.2f}s wall, "
+              f"{cpu_seconds:.2f}s CPU, {peak_memory / (1024 * 1024):.1f} MB peak")
+    except Exception as e:
+        # A profile that cannot be stored must never fail the stage it measured
+        print(f"Error storing profile for stage '{stage}': {str(e)}")
+
+@anvil.server.callable
+def get_pipeline_profiles(newsletter_id):
+    """Returns the stored profiles of a newsletter's pipeline stages, newest first."""
+    rows = app_tables.pipelineprofiles.search(
+        tables.order_by('created', ascending=False),
+        newsletter_id=newsletter_id
+    )
+    return [
+        {
+            'stage': row['stage'],
+            'created': row['created'].isoformat() if row['created'] else None,
+            'wall_seconds': row['wall_seconds'],
+            'cpu_seconds': row['cpu_seconds'],
+            'peak_memory_bytes': row['peak_memory_bytes'],
+            'top_functions': row['top_functions'],
+            'top_allocations': row['top_allocations'],
+            'error': row['error'],
+        }
+        for row in rows
+    ]
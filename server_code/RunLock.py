@@ -0,0 +1,95 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import datetime
+import uuid
+
+# This module keeps overlapping pipeline runs from stepping on each other.
+#
+# Primary responsibilities:
+# 1. Lease-based locks stored in the runlocks table. A lease has an owner token and an
+#    expiry; the owner extends it with heartbeat() while it works. A lease whose holder
+#    died simply expires, so no manual cleanup is ever needed.
+# 2. Idempotent inserts keyed on an idempotency_key column. Keys are derived from the
+#    Gmail message ID, so the same email can never produce two newsletters,
+#    newsletteranalysis or newsletteroptimized rows, whichever run gets there first.
+#
+# Locks are taken per newsletter_id ('pipeline:<newsletter_id>'), so a backfill of one
+# day can run in parallel with the live poll of another.
+
+# Default lease length. Runs call heartbeat() between stages to extend it.
+LEASE_SECONDS = 15 * 60
+
+def _now():
+    return datetime.datetime.now()
+
+def _as_naive(value):
+    return value.replace(tzinfo=None) if value is not None else None
+
+@tables.in_transaction
+def acquire_lease(name, ttl_seconds=LEASE_SECONDS):
+    """
+    Tries to take the lease called name.
+    Returns an owner token on success, or None if another live holder has it.
+    """
+    now = _now()
+    lock = app_tables.runlocks.get(name=name)
+    if lock is not None and lock['owner'] and _as_naive(lock['expires']) > now:
+        print(f"Lease '{name}' is held by {lock['owner']} until {lock['expires']}")
+        return None
+
+    owner = uuid.uuid4().hex
+    expires = now + datetime.timedelta(seconds=ttl_seconds)
+    if lock is None:
+        app_tables.runlocks.add_row(name=name, owner=owner, acquired=now, heartbeat=now, expires=expires)
+    else:
+        lock.update(owner=owner, acquired=now, heartbeat=now, expires=expires)
+    print(f"Lease '{name}' acquired by {owner}")
+    return owner
+
+@tables.in_transaction
+def heartbeat(name, owner, ttl_seconds=LEASE_SECONDS):
+    """
+    Extends a lease held by owner. Raises RuntimeError if the lease was lost,
+    so the caller stops before it writes anything a new holder might also write.
+    """
+    lock = app_tables.runlocks.get(name=name)
+    if lock is None or lock['owner'] != owner:
+        raise RuntimeError(f"Lease '{name}' is no longer held by {owner}")
+    now = _now()
+    lock.update(heartbeat=now, expires=now + datetime.timedelta(seconds=ttl_seconds))
+
+@tables.in_transaction
+def release_lease(name, owner):
+    """Releases a lease if owner still holds it."""
+    lock = app_tables.runlocks.get(name=name)
+    if lock is not None and lock['owner'] == owner:
+        lock.update(owner=None, expires=_now())
+        print(f"Lease '{name}' released by {owner}")
+
+def pipeline_lease_name(newsletter_id):
+    return f"pipeline:{newsletter_id}"
+
+@tables.in_transaction
+def add_row_once(table, idempotency_key, **values):
+    """
+    Adds a row to table unless a row with the same idempotency_key exists.
+    Returns (row, created).
+    """
+    existing = table.get(idempotency_key=idempotency_key)
+    if existing is not None:
+        return existing, False
+    return table.add_row(idempotency_key=idempotency_key, **values), True
+
+def newsletter_idempotency_key(kind, newsletter_id):
+    """
+    Returns the idempotency key for a row of the given kind ('analysis', 'optimized', ...)
+    belonging to newsletter_id. Derived from the newsletter's Gmail message ID; newsletters
+    stored before message IDs were recorded fall back to the newsletter_id.
+    """
+    newsletter = app_tables.newsletters.search(newsletter_id=newsletter_id)
+    message_id = next((row['gmail_message_id'] for row in newsletter if row['gmail_message_id']), None)
+    if message_id:
+        return f"{kind}:{message_id}"
+    return f"{kind}:id:{newsletter_id}"
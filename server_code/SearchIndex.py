@@ -0,0 +1,264 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import datetime
+import math
+import re
+
+# This module maintains a full-text inverted index over the newsletter history.
+#
+# Primary responsibilities:
+# 1. Tokenizes newsletter text and stores one posting (term, newsletter_id, positions)
+#    per distinct term in the searchpostings table
+# 2. Keeps the index current incrementally: a newsletter is indexed when it is stored
+#    and re-indexed with its optimized text when it is optimized
+# 3. Answers phrase and boolean queries, ranked with BM25, by reading only the
+#    postings of the query terms instead of scanning newsletter bodies
+#
+# Query syntax (case-insensitive):
+#   FOMC                   newsletters containing the term
+#   "gap fill"             the exact phrase
+#   FOMC "gap fill"        both (AND is implicit; the keyword AND is also accepted)
+#   FOMC OR CPI            either
+#   FOMC -CPI / FOMC NOT CPI   FOMC but not CPI
+#
+# Tables:
+# - searchpostings: term, newsletter_id, positions (list of token offsets), tf
+# - searchdocuments: newsletter_id, length (tokens), source ('original' or 'optimized')
+# - searchstats: a single row with the document count and total length, for BM25
+
+STATS_NAME = 'default'
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+DEFAULT_RESULT_LIMIT = 20
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+_QUERY_PATTERN = re.compile(r'(-?)"([^"]*)"|(\S+)')
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall((text or '').lower())
+
+def _get_stats():
+    stats = app_tables.searchstats.get(name=STATS_NAME)
+    if stats is None:
+        stats = app_tables.searchstats.add_row(name=STATS_NAME, documents=0, total_length=0)
+    return stats
+
+def _adjust_stats(documents, length):
+    """Call inside the transaction that changed the index."""
+    stats = _get_stats()
+    stats.update(
+        documents=(stats['documents'] or 0) + documents,
+        total_length=(stats['total_length'] or 0) + length
+    )
+
+def _delete_newsletter(newsletter_id):
+    """
+    Deletes a newsletter's postings and document rows and takes them out of the stats.
+    Postings are deleted even without a document row, so a partial index never lingers.
+    Call inside a transaction.
+    """
+    documents = app_tables.searchdocuments.search(newsletter_id=newsletter_id)
+    removed_documents = len(documents)
+    removed_length = sum(document['length'] or 0 for document in documents)
+    app_tables.searchpostings.search(newsletter_id=newsletter_id).delete_all_rows()
+    documents.delete_all_rows()
+    if removed_documents:
+        _adjust_stats(-removed_documents, -removed_length)
+
+@tables.in_transaction
+def remove_newsletter(newsletter_id):
+    """Removes a newsletter's postings from the index."""
+    _delete_newsletter(newsletter_id)
+
+@tables.in_transaction
+def _replace_newsletter(newsletter_id, postings, length, source):
+    _delete_newsletter(newsletter_id)
+    app_tables.searchpostings.add_rows(postings)
+    app_tables.searchdocuments.add_row(
+        newsletter_id=newsletter_id,
+        length=length,
+        source=source,
+        indexed_at=datetime.datetime.now()
+    )
+    _adjust_stats(1, length)
+
+def index_newsletter(newsletter_id, text, source):
+    """
+    (Re-)indexes one newsletter. source records which text was indexed
+    ('original' on insert, 'optimized' once the newsletter has been optimized).
+    The old postings, the new postings, the document row and the stats change in
+    one transaction, written in batches.
+    """
+    tokens = tokenize(text)
+    positions = {}
+    for position, token in enumerate(tokens):
+        positions.setdefault(token, []).append(position)
+
+    postings = [
+        {'term': term, 'newsletter_id': newsletter_id, 'positions': term_positions, 'tf': len(term_positions)}
+        for term, term_positions in positions.items()
+    ]
+    _replace_newsletter(newsletter_id, postings, len(tokens), source)
+    print(f"Indexed newsletter {newsletter_id} ({source}): {len(tokens)} tokens, {len(positions)} terms")
+
+def parse_query(query):
+    """
+    Parses a query into OR-groups of clauses. Each clause is a dict with
+    'terms' (a single term, or several for a phrase) and 'negated'.
+    """
+    groups = [[]]
+    negate_next = False
+    for match in _QUERY_PATTERN.finditer(query or ''):
+        minus, phrase, word = match.groups()
+        if word is not None:
+            keyword = word.upper()
+            if keyword == 'OR':
+                if groups[-1]:
+                    groups.append([])
+                continue
+            if keyword == 'AND':
+                continue
+            if keyword == 'NOT':
+                negate_next = True
+                continue
+            negated = word.startswith('-')
+            terms = tokenize(word[1:] if negated else word)
+        else:
+            negated = bool(minus)
+            terms = tokenize(phrase)
+        if terms:
+            groups[-1].append({'terms': terms, 'negated': negated or negate_next})
+        negate_next = False
+    return [group for group in groups if group]
+
+def _postings(term, cache):
+    """Returns {newsletter_id: positions} for a term."""
+    if term not in cache:
+        rows = app_tables.searchpostings.search(q.fetch_only('newsletter_id', 'positions'), term=term)
+        cache[term] = {row['newsletter_id']: row['positions'] for row in rows}
+    return cache[term]
+
+def _clause_matches(clause, cache):
+    """Returns {newsletter_id: occurrence count} for a term or phrase clause."""
+    terms = clause['terms']
+    if len(terms) == 1:
+        return {doc: len(positions) for doc, positions in _postings(terms[0], cache).items()}
+
+    postings = [_postings(term, cache) for term in terms]
+    candidates = set(postings[0])
+    for term_postings in postings[1:]:
+        candidates &= set(term_postings)
+
+    matches = {}
+    for doc in candidates:
+        following = [set(term_postings[doc]) for term_postings in postings[1:]]
+        count = sum(
+            1 for start in postings[0][doc]
+            if all(start + offset + 1 in positions for offset, positions in enumerate(following))
+        )
+        if count:
+            matches[doc] = count
+    return matches
+
+def _bm25(tf, df, length, documents, average_length):
+    idf = math.log(1 + (documents - df + 0.5) / (df + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length) if average_length else BM25_K1
+    return idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+@anvil.server.callable
+def search_newsletters(query, limit=DEFAULT_RESULT_LIMIT):
+    """
+    Searches the newsletter history. Returns up to limit results, best first:
+      [{'newsletter_id', 'score', 'subject', 'date'}, ...]
+    """
+    groups = parse_query(query)
+    if not groups:
+        return []
+
+    stats = _get_stats()
+    documents = stats['documents'] or 0
+    average_length = (stats['total_length'] or 0) / documents if documents else 0
+
+    cache = {}
+    scores = {}
+    for group in groups:
+        positive = [c for c in group if not c['negated']]
+        negative = [c for c in group if c['negated']]
+        if not positive:
+            continue
+
+        clause_matches = [_clause_matches(clause, cache) for clause in positive]
+        docs = set(clause_matches[0])
+        for matches in clause_matches[1:]:
+            docs &= set(matches)
+        for clause in negative:
+            docs -= set(_clause_matches(clause, cache))
+        if not docs:
+            continue
+
+        lengths = {
+            row['newsletter_id']: row['length']
+            for row in app_tables.searchdocuments.search(
+                q.fetch_only('newsletter_id', 'length'),
+                newsletter_id=q.any_of(*docs)
+            )
+        }
+        for doc in docs:
+            score = sum(
+                _bm25(matches[doc], len(matches), lengths.get(doc, 0), documents, average_length)
+                for matches in clause_matches
+            )
+            scores[doc] = max(scores.get(doc, 0), score)
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+    if not ranked:
+        return []
+
+    newsletters = {
+        row['newsletter_id']: row
+        for row in app_tables.newsletters.search(
+            q.fetch_only('newsletter_id', 'timestamp', 'newslettersubject'),
+            newsletter_id=q.any_of(*[doc for doc, _ in ranked])
+        )
+    }
+    results = []
+    for doc, score in ranked:
+        row = newsletters.get(doc)
+        results.append({
+            'newsletter_id': doc,
+            'score': round(score, 4),
+            'subject': row['newslettersubject'] if row else None,
+            'date': row['timestamp'] if row else None,
+        })
+    return results
+
+@anvil.server.callable
+@anvil.server.background_task
+def rebuild_search_index(only_missing=True):
+    """
+    Indexes the stored archive. With only_missing, newsletters already in the index are
+    skipped, so this can be re-run to back-fill after an interruption.
+    """
+    from . import BodyStore, HtmlText
+
+    indexed = 0
+    for newsletter in app_tables.newsletters.search():
+        newsletter_id = newsletter['newsletter_id']
+        if only_missing and app_tables.searchdocuments.get(newsletter_id=newsletter_id) is not None:
+            continue
+        optimized = next(iter(app_tables.newsletteroptimized.search(
+            tables.order_by('timestamp', ascending=False),
+            newsletter_id=newsletter_id
+        )), None)
+        if optimized is not None:
+            index_newsletter(newsletter_id, BodyStore.read_optimized_content(optimized), 'optimized')
+        else:
+            index_newsletter(newsletter_id, HtmlText.body_text(BodyStore.read_newsletter_body(newsletter)), 'original')
+        indexed += 1
+    print(f"Search index rebuilt: {indexed} newsletters indexed")
+    return indexed
@@ -0,0 +1,271 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import datetime
+import hashlib
+import re
+
+# This module is the incremental diff stage of the optimization pipeline.
+#
+# Primary responsibilities:
+# 1. Splits the cleaned newsletter body into sections at its headers
+# 2. Fingerprints every section (hash of its whitespace/case-normalized text)
+# 3. Compares the fingerprints with the previous newsletter's sections
+# 4. Runs extraction only on changed sections, reusing cached results for unchanged ones
+# 5. Builds the newsletter's key levels from the extractions and records which were
+#    added or removed since the previous newsletter
+#
+# Consecutive newsletters repeat large blocks (the level-approach explanation, education
+# text, most core levels), so most sections hit the sectionextractions cache.
+#
+# Tables:
+# - sectionextractions: one row per (fingerprint, version) holding the extraction result
+# - newslettersections: one row per newsletter_id with its section fingerprints, the
+#   NLP features of each section, its key levels and the levels added/removed against
+#   the previous newsletter
+
+# Bump when extract_section changes so stale cached results are not reused
+EXTRACTION_VERSION = 2
+
+# Known newsletter headers. Each match starts a new section.
+SECTION_HEADER_PATTERN = re.compile(
+    r"^\s*(?:"
+    r"The Run Down on The Level To Level Approach.*"
+    r"|Core Structures.*"
+    r"|Levels To Engage.*"
+    r"|Key Levels.*"
+    r"|Trade Recap.*"
+    r"|Trading Recap.*"
+    r"|Trade Education.*"
+    r"|Trade Plan.*"
+    r"|Important Housekeeping Notices.*"
+    r")\s*$",
+    re.IGNORECASE
+)
+
+# Sections whose digit-led lines are key levels
+LEVEL_SECTION_PATTERN = re.compile(r"core structures|levels to engage|key levels", re.IGNORECASE)
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def fingerprint(text):
+    """Returns a stable fingerprint of a section's content."""
+    return hashlib.sha1(_normalize(text).encode('UTF-8')).hexdigest()
+
+def _rule_headers(section_rules, section_type=None):
+    """Returns the lowercased headers from a sender's section rules."""
+    headers = []
+    for rule_type, rule_headers in (section_rules or {}).items():
+        if section_type is None or rule_type == section_type:
+            headers.extend(header.lower() for header in rule_headers)
+    return headers
+
+def _is_header(line, extra_headers):
+    if SECTION_HEADER_PATTERN.match(line):
+        return True
+    stripped = line.strip().lower()
+    return any(stripped.startswith(header) for header in extra_headers)
+
+def split_sections(text, section_rules=None):
+    """
+    Splits text into sections at known headers, plus the headers of the sender's
+    section rules. Returns a list of dicts with 'title', 'text', 'is_levels' and
+    'fingerprint'. Text before the first header becomes a section titled 'Preamble'.
+    """
+    extra_headers = _rule_headers(section_rules)
+    level_headers = _rule_headers(section_rules, 'core_levels')
+    sections = []
+    title = 'Preamble'
+    lines = []
+
+    def flush():
+        body = "\n".join(lines).strip()
+        if body or title != 'Preamble':
+            is_levels = bool(LEVEL_SECTION_PATTERN.search(title)) or any(
+                title.lower().startswith(header) for header in level_headers
+            )
+            sections.append({
+                'title': title,
+                'text': body,
+                'is_levels': is_levels,
+                'fingerprint': fingerprint(f"{'levels' if is_levels else 'text'}\n{title}\n{body}")
+            })
+
+    for line in text.split('\n'):
+        if _is_header(line, extra_headers):
+            flush()
+            title = line.strip()
+            lines = []
+        else:
+            lines.append(line)
+    flush()
+    return sections
+
+def extract_section(section, features):
+    """
+    Builds the extraction result of a single section from its NLP features
+    (see TextPipeline.extract_section_features). The result is cached by fingerprint,
+    so it must only depend on what the fingerprint covers: title, text and is_levels.
+    """
+    from . import OptimizeNewsletter
+
+    text = section['text']
+    # The digit-led lines of a level section, and the level (text before the colon) of each
+    levels = []
+    level_lines = []
+    if section['is_levels']:
+        for line in OptimizeNewsletter.format_preserved_levels(text).splitlines():
+            level = OptimizeNewsletter.format_keylevels_raw(line)
+            if level:
+                levels.append(level)
+                level_lines.append(line)
+
+    return {
+        'levels': levels,
+        'level_lines': level_lines,
+        'support_resistance': features['support_resistance'],
+        'price_levels': features['price_levels'],
+        'sentiment': features['sentiment'],
+        'trade_setups': OptimizeNewsletter.identify_trade_setups(text),
+        'risk_score': OptimizeNewsletter.calculate_risk_factors(text)['risk_score'],
+    }
+
+def extract_sections(sections):
+    """
+    Extracts several sections, running the NLP components over all of them in one
+    batch (a single round trip when the Uplink NLP worker is connected).
+    """
+    from . import OptimizeNewsletter
+    features = OptimizeNewsletter.extract_sections_features([section['text'] for section in sections])
+    return [extract_section(section, section_features) for section, section_features in zip(sections, features)]
+
+def _cached_extraction(section_fingerprint):
+    row = app_tables.sectionextractions.get(fingerprint=section_fingerprint, version=EXTRACTION_VERSION)
+    return row['extraction'] if row is not None else None
+
+def _store_extraction(section_fingerprint, extraction):
+    if app_tables.sectionextractions.get(fingerprint=section_fingerprint, version=EXTRACTION_VERSION) is None:
+        app_tables.sectionextractions.add_row(
+            fingerprint=section_fingerprint,
+            version=EXTRACTION_VERSION,
+            extraction=extraction,
+            created=datetime.datetime.now()
+        )
+
+def previous_sections_row(newsletter_id):
+    """Returns the newslettersections row of the same sender's newsletter before newsletter_id, or None."""
+    from . import utils
+    rows = app_tables.newslettersections.search(
+        tables.order_by('newsletter_id', ascending=False),
+        sender=utils.sender_key_of(newsletter_id),
+        newsletter_id=q.less_than(newsletter_id)
+    )
+    for row in rows:
+        return row
+    return None
+
+def diff_against_previous(newsletter_id, cleaned_body, section_rules=None):
+    """
+    Splits, fingerprints and extracts the sections of cleaned_body, reusing cached
+    extractions for sections seen before, and diffs the key levels against the
+    previous newsletter. Stores and returns the result.
+    """
+    from . import utils
+    sections = split_sections(cleaned_body, section_rules)
+    previous = previous_sections_row(newsletter_id)
+    previous_fingerprints = {s['fingerprint'] for s in (previous['sections'] if previous else [])}
+
+    extractions = [_cached_extraction(section['fingerprint']) for section in sections]
+    uncached = [i for i, extraction in enumerate(extractions) if extraction is None]
+    reused = len(sections) - len(uncached)
+    for i, extraction in zip(uncached, extract_sections([sections[i] for i in uncached])):
+        _store_extraction(sections[i]['fingerprint'], extraction)
+        extractions[i] = extraction
+    changed = sum(1 for section in sections if section['fingerprint'] not in previous_fingerprints)
+    print(f"Section diff for {newsletter_id}: {len(sections)} sections, "
+          f"{changed} changed since previous newsletter, {reused} extractions reused from cache")
+
+    # The key levels of the newsletter: the levels of its sections' extractions,
+    # de-duplicated by level. OptimizeNewsletter stores these as keylevels/keylevelsraw,
+    # so the stored levels and the added/removed diff always cover the same set.
+    levels = []
+    level_lines = []
+    for extraction in extractions:
+        for level, line in zip(extraction['levels'], extraction['level_lines']):
+            if level not in levels:
+                levels.append(level)
+                level_lines.append(line)
+
+    # The remaining NLP features, per section
+    section_features = [
+        {
+            'title': section['title'],
+            'support_resistance': extraction['support_resistance'],
+            'price_levels': extraction['price_levels'],
+            'sentiment': extraction['sentiment'],
+            'trade_setups': extraction['trade_setups'],
+            'risk_score': extraction['risk_score'],
+        }
+        for section, extraction in zip(sections, extractions)
+    ]
+
+    previous_levels = previous['levels'] if previous else []
+    levels_added = [level for level in levels if level not in previous_levels] if previous else []
+    levels_removed = [level for level in previous_levels if level not in levels]
+
+    result = {
+        'newsletter_id': newsletter_id,
+        'previous_newsletter_id': previous['newsletter_id'] if previous else None,
+        'sections': [
+            {'title': s['title'], 'fingerprint': s['fingerprint'], 'length': len(s['text'])}
+            for s in sections
+        ],
+        'changed_sections': [
+            s['title'] for s in sections if s['fingerprint'] not in previous_fingerprints
+        ],
+        'section_features': section_features,
+        'levels': levels,
+        'formatted_levels': "\n".join(level_lines),
+        'levels_added': levels_added,
+        'levels_removed': levels_removed,
+    }
+
+    stored_values = dict(
+        previous_newsletter_id=result['previous_newsletter_id'],
+        sections=result['sections'],
+        section_features=section_features,
+        levels=levels,
+        levels_added=levels_added,
+        levels_removed=levels_removed,
+        changed_sections=changed,
+        reused_extractions=reused,
+        timestamp=datetime.datetime.now()
+    )
+    row = app_tables.newslettersections.get(newsletter_id=newsletter_id)
+    if row is None:
+        app_tables.newslettersections.add_row(
+            newsletter_id=newsletter_id,
+            sender=utils.sender_key_of(newsletter_id),
+            **stored_values
+        )
+    else:
+        row.update(**stored_values)
+
+    if previous:
+        print(f"Levels since {previous['newsletter_id']}: {len(levels_added)} added, {len(levels_removed)} removed")
+    return result
+
+@anvil.server.callable
+def get_level_changes(newsletter_id):
+    """Returns the key levels added and removed since the previous newsletter."""
+    row = app_tables.newslettersections.get(newsletter_id=newsletter_id)
+    if row is None:
+        return None
+    return {
+        'newsletter_id': newsletter_id,
+        'previous_newsletter_id': row['previous_newsletter_id'],
+        'levels_added': row['levels_added'],
+        'levels_removed': row['levels_removed'],
+    }
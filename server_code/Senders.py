@@ -0,0 +1,87 @@
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.secrets
+import anvil.server
+
+# This module is the registry of newsletters we ingest.
+#
+# Primary responsibilities:
+# 1. Reads the configured senders from the newslettersenders table
+# 2. Falls back to the single newsletter_sender_email secret when the table is empty
+# 3. Maps a sender to its newsletter_id, Gmail query, cleaning profile and section rules
+#
+# Sender rows (newslettersenders table):
+# - name: short slug, used as the newsletter_id suffix ('YYYYMMDD-<name>')
+# - sender_email: From address of the newsletter
+# - query: Gmail search query; defaults to 'from:<sender_email>'
+# - cleaning_profile: key of OptimizeNewsletter.CLEANING_PROFILES; defaults to 'default'
+# - section_rules: optional {'core_levels': [...headers], 'trade_recap': [...headers]}
+#   overriding the headers semantic_section_chunker looks for
+# - primary: the primary sender keeps plain 'YYYYMMDD' newsletter_ids, so rows stored
+#   before the registry existed stay attached to it
+# - enabled: disabled senders are skipped
+#
+# Senders are passed around as plain dicts, so they can be handed to worker threads.
+
+DEFAULT_SENDER_NAME = 'default'
+
+def _sender_from_row(row):
+    return {
+        'name': row['name'],
+        'sender_email': row['sender_email'],
+        'query': row['query'] or f"from:{row['sender_email']}",
+        'cleaning_profile': row['cleaning_profile'] or 'default',
+        'section_rules': row['section_rules'] or None,
+        'primary': bool(row['primary']),
+    }
+
+def _default_sender():
+    sender_email = anvil.secrets.get_secret('newsletter_sender_email')
+    return {
+        'name': DEFAULT_SENDER_NAME,
+        'sender_email': sender_email,
+        'query': f"from:{sender_email}",
+        'cleaning_profile': 'default',
+        'section_rules': None,
+        'primary': True,
+    }
+
+def get_senders():
+    """Returns every enabled sender. The primary sender comes first."""
+    senders = [_sender_from_row(row) for row in app_tables.newslettersenders.search(enabled=True)]
+    if not senders:
+        return [_default_sender()]
+    return sorted(senders, key=lambda sender: not sender['primary'])
+
+def primary_sender():
+    return get_senders()[0]
+
+def get_sender(sender_key):
+    """Returns the sender for a sender key (None means the primary sender)."""
+    senders = get_senders()
+    if sender_key is None:
+        return senders[0]
+    for sender in senders:
+        if sender['name'] == sender_key and not sender['primary']:
+            return sender
+    row = app_tables.newslettersenders.get(name=sender_key)
+    if row is None:
+        raise ValueError(f"Unknown newsletter sender: {sender_key}")
+    return _sender_from_row(row)
+
+def sender_key(sender):
+    """The key stored with a sender's rows: None for the primary sender, its name otherwise."""
+    return None if sender['primary'] else sender['name']
+
+def newsletter_id_for(base_newsletter_id, sender):
+    """Returns the newsletter_id of sender's newsletter for the trading day base_newsletter_id."""
+    key = sender_key(sender)
+    return base_newsletter_id if key is None else f"{base_newsletter_id}-{key}"
+
+def sender_for_message(from_header):
+    """Returns the sender whose email appears in a From header, or None."""
+    for sender in get_senders():
+        if sender['sender_email'] and sender['sender_email'].lower() in from_header.lower():
+            return sender
+    return None
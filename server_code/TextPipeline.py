@@ -0,0 +1,245 @@
+import re
+
+# This module holds the spaCy pipeline used to optimize newsletters.
+# It has no Anvil imports, so it runs unchanged in two places:
+# - on the Anvil server, through OptimizeNewsletter, when no NLP worker is connected
+# - in local_tools/nlp_worker.py, an Uplink worker that keeps the pipeline warm in
+#   memory across calls
+#
+# The pipeline is built lazily by get_nlp(): importing this module does not load spaCy,
+# so the Anvil server never pays the model load when the worker does the work.
+#
+# Public functions take and return plain Python data (no spaCy objects), so their
+# results can be sent over Uplink.
+
+SPACY_MODEL = "en_core_web_sm"
+
+_nlp = None
+
+def support_resistance_detector(doc):
+    """Custom spaCy pipeline component to detect support/resistance levels."""
+    pattern = r"(\d+\.\d+)\s*(?:support|resistance)"
+    matches = re.findall(pattern, doc.text, flags=re.IGNORECASE)
+    doc._.support_resistance = matches
+    return doc
+
+def market_sentiment_analyzer(doc):
+    """Analyzes market sentiment in the text."""
+    bullish_terms = ['bullish', 'upward', 'higher', 'rally', 'squeeze', 'long']
+    bearish_terms = ['bearish', 'downward', 'lower', 'breakdown', 'short', 'sell']
+    
+    bull_count = 0
+    bear_count = 0
+    
+    for token in doc:
+        if token.text.lower() in bullish_terms:
+            bull_count += 1
+        elif token.text.lower() in bearish_terms:
+            bear_count += 1
+    
+    total = bull_count + bear_count
+    if total > 0:
+        sentiment_score = (bull_count - bear_count) / total  # -1 to 1 scale
+    else:
+        sentiment_score = 0
+        
+    doc._.market_sentiment = {
+        'score': sentiment_score,
+        'bullish_mentions': bull_count,
+        'bearish_mentions': bear_count
+    }
+    return doc
+
+def price_level_detector(doc):
+    """Detects price levels and their context (support/resistance/target)."""
+    price_pattern = r'(\d{4}(?:\.\d{1,2})?)'  # Matches 4-digit prices with optional decimals
+    level_info = []
+    
+    for match in re.finditer(price_pattern, doc.text):
+        price = match.group(1)
+        # Get surrounding context (20 chars before and after)
+        start = max(0, match.start() - 20)
+        end = min(len(doc.text), match.end() + 20)
+        context = doc.text[start:end]
+        
+        level_type = 'unknown'
+        if 'support' in context.lower():
+            level_type = 'support'
+        elif 'resistance' in context.lower():
+            level_type = 'resistance'
+        elif 'target' in context.lower():
+            level_type = 'target'
+            
+        level_info.append({
+            'price': price,
+            'type': level_type,
+            'context': context.strip()
+        })
+    
+    doc._.price_levels = level_info
+    return doc
+
+def semantic_section_chunker(doc):
+    """Identifies and chunks newsletter sections based on semantic headers and content."""
+    # Define common newsletter section headers with more variations.
+    # A sender's section_rules (see Senders.py) replace these when set.
+    section_headers = doc._.section_rules or {
+        'core_levels': ['core structures', 'key levels', 'levels to engage', 'Core Structures', 'CORE STRUCTURES',
+                       'Key Levels', 'KEY LEVELS', 'Levels to Engage', 'LEVELS TO ENGAGE'],
+        'trade_recap': ['trade recap', 'trading recap', 'trade education', 'Trade Recap', 'TRADE RECAP',
+                       'Trading Recap', 'TRADING RECAP', 'Trade Education', 'TRADE EDUCATION']
+    }
+    
+    # Store identified sections
+    doc._.sections = {}
+    
+    # Initialize trade_plan_start outside the conditional block
+    trade_plan_start = -1
+    
+    # First find the trade plan section as it will be used as a boundary
+    if doc._.trading_day:  # Only proceed if we have the trading day information
+        print(f"\nLooking for trade plan section for {doc._.trading_day}")
+        plan_day_pattern = fr"Trade Plan\s*[:\-]?\s*{doc._.trading_day}"
+        plan_day_matches = list(re.finditer(plan_day_pattern, doc.text, re.IGNORECASE))
+        if plan_day_matches:
+            print(f"\nFound {len(plan_day_matches)} instances of 'Trade Plan {doc._.trading_day}':")
+            match = plan_day_matches[0]
+            section_start = match.start()
+            # Look for the next header from a list of known section headers
+            next_header_pattern = r"\n\s*(?:Trade Recap|Trading Recap|Trade Education|Core Structures|Levels to Engage)\b"
+            next_header_match = re.search(next_header_pattern, doc.text[section_start:], re.IGNORECASE)
+            if next_header_match:
+                section_end = section_start + next_header_match.start()
+            else:
+                section_end = len(doc.text)
+            doc._.sections['trade_plan'] = doc.text[section_start:section_end].strip()
+            print(f"Extracted trade_plan section, length: {len(doc._.sections['trade_plan'])} chars")
+        else:
+            print(f"No instances of 'Trade Plan {doc._.trading_day}' found!")
+    
+    # Find section boundaries for other sections
+    section_spans = []
+    for section_type, headers in section_headers.items():
+        for header in headers:
+            # Use re.finditer for case-insensitive matching
+            matches = re.finditer(re.escape(header), doc.text, re.IGNORECASE)
+            for match in matches:
+                section_spans.append((match.start(), section_type))
+                print(f"Found {section_type} section with header: {header}")
+    
+    # Sort section spans by their start position
+    section_spans.sort(key=lambda x: x[0])
+    
+    # Extract sections
+    for i in range(len(section_spans)):
+        start_pos = section_spans[i][0]
+        section_type = section_spans[i][1]
+        
+        # End position is either the start of next section, trade plan start, or end of document
+        if i < len(section_spans) - 1:
+            end_pos = section_spans[i + 1][0]
+        else:
+            end_pos = len(doc.text)
+        
+        # If this is the trade_recap section and we found a trade plan, use trade plan start as boundary
+        if section_type == 'trade_recap' and trade_plan_start != -1:
+            end_pos = min(end_pos, trade_plan_start)
+        
+        # Find the actual start of content (skip header line)
+        section_text = doc.text[start_pos:end_pos]
+        content_start = section_text.find('\n')
+        if content_start != -1:
+            start_pos += content_start + 1
+        
+        # Store the section content
+        section_content = doc.text[start_pos:end_pos].strip()
+        doc._.sections[section_type] = section_content
+        print(f"Stored {section_type} section with length: {len(section_content)} chars")
+    
+    # Debug print final sections
+    print("Final sections found:", list(doc._.sections.keys()))
+    
+    return doc
+
+
+def get_nlp():
+    """Returns the newsletter spaCy pipeline, loading and assembling it on first use."""
+    global _nlp
+    if _nlp is not None:
+        return _nlp
+
+    import spacy
+    from spacy.language import Language
+    from spacy.tokens import Doc
+
+    # Initialize spaCy model for newsletter analysis
+    try:
+        nlp = spacy.load(SPACY_MODEL)
+    except OSError:
+        import spacy.cli
+        spacy.cli.download(SPACY_MODEL)
+        nlp = spacy.load(SPACY_MODEL)
+
+    # Register the Doc extensions used by the custom components
+    for name, default in [("support_resistance", []), ("market_sentiment", {}), ("price_levels", []),
+                          ("sections", {}), ("section_rules", None), ("trading_day", None)]:
+        if not Doc.has_extension(name):
+            Doc.set_extension(name, default=default)
+
+    # Register the custom components by name and add them to the pipeline in order
+    components = [
+        ("support_resistance_detector", support_resistance_detector),
+        ("price_level_detector", price_level_detector),
+        ("market_sentiment_analyzer", market_sentiment_analyzer),
+        ("semantic_section_chunker", semantic_section_chunker),
+    ]
+    for name, component in components:
+        if not Language.has_factory(name):
+            Language.component(name, func=component)
+        if name not in nlp.pipe_names:
+            nlp.add_pipe(name, last=True)
+
+    _nlp = nlp
+    return _nlp
+
+def get_newsletter_sections(text):
+    """Process newsletter text and return semantically chunked sections."""
+    doc = get_nlp()(text)
+    return doc._.sections
+
+def chunk_sections(text, trading_day, section_rules=None):
+    """
+    Runs only the semantic_section_chunker over text, with the trading day (and the
+    sender's section rules, if any) set before the chunker runs so it can find the
+    'Trade Plan <day>' section. The per-section extraction is done incrementally by
+    SectionDiff, so the full document does not need the rest of the pipeline.
+    """
+    nlp = get_nlp()
+    doc = nlp.make_doc(text)
+    doc._.trading_day = trading_day
+    doc._.section_rules = section_rules
+    doc = nlp.get_pipe("semantic_section_chunker")(doc)
+    return dict(doc._.sections)
+
+def extract_key_levels(text):
+    """Extracts key support/resistance levels using the custom spaCy pipeline."""
+    doc = get_nlp()(text)
+    return list(doc._.support_resistance)
+
+def extract_section_features(text):
+    """
+    Runs the extraction components (levels, prices, sentiment) over a single section.
+    Returns {'support_resistance', 'price_levels', 'sentiment'}.
+    """
+    nlp = get_nlp()
+    with nlp.select_pipes(disable=["semantic_section_chunker"]):
+        doc = nlp(text)
+    return {
+        'support_resistance': list(doc._.support_resistance),
+        'price_levels': [level['price'] for level in doc._.price_levels],
+        'sentiment': dict(doc._.market_sentiment),
+    }
+
+def extract_sections_features(texts):
+    """Batch form of extract_section_features, one result per text."""
+    return [extract_section_features(text) for text in texts]
@@ -1,3 +1,4 @@
+import anvil.secrets
 import datetime
 
 def get_newsletter_id(session_date=None):
@@ -32,4 +33,28 @@ def get_newsletter_id(session_date=None):
     # Get the day name for the trading session
     trading_day_name = next_trading_day.strftime("%A")
     
-    return next_trading_day.strftime("%Y%m%d"), trading_day_name 
\ No newline at end of file
+    return next_trading_day.strftime("%Y%m%d"), trading_day_name 
+
+def get_optional_secret(name, default=None):
+    """
+    Returns the value of an Anvil secret, or default when the secret is not defined or empty.
+    Used for optional configuration that the app can run without.
+    """
+    try:
+        value = anvil.secrets.get_secret(name)
+    except Exception:
+        return default
+    if value is None or value == '':
+        return default
+    return value
+
+def newsletter_date(newsletter_id):
+    """
+    Returns the trading day of a newsletter_id as a datetime.
+    Works for primary IDs ('yyyymmdd') and sender IDs ('yyyymmdd-<sender>').
+    """
+    return datetime.datetime.strptime(newsletter_id[:8], "%Y%m%d")
+
+def sender_key_of(newsletter_id):
+    """Returns the sender part of a newsletter_id, or None for the primary sender."""
+    return newsletter_id[9:] if len(newsletter_id) > 8 and newsletter_id[8] == '-' else None